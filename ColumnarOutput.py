@@ -0,0 +1,114 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+
+'''Columnar output for generated events.
+Events are written to a Parquet file as typed columns, with the repeated strings dictionary
+encoded and every ROW_GROUP_SIZE events compressed into a row group, so large corpora can be
+memory-mapped and scanned a column at a time without parsing JSON.
+Requires the pyarrow package, which is only imported when columnar output is used.'''
+
+"""
+Import pyarrow and pyarrow.parquet, raising ImportError with installation advice if they
+are missing.
+"""
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet output requires the pyarrow package (pip install pyarrow).')
+    return pyarrow, pyarrow.parquet
+
+"""
+The ParquetEventWriter class converts batches of JSON events into columns and writes them
+out as Parquet row groups.
+The event type and the fields common to most events get their own column; the remaining
+fields of each event are kept as a JSON object in the 'fields' column.
+"""
+class ParquetEventWriter:
+    ROW_GROUP_SIZE = 100000
+    # (column, type name); string columns are dictionary encoded
+    COLUMNS = [
+        ('type', 'string'),
+        ('time', 'int64'),
+        ('host', 'string'),
+        ('index', 'int64'),
+        ('pid', 'int64'),
+        ('ppid', 'int64'),
+        ('user', 'string'),
+        ('process', 'string'),
+        ('action', 'string'),
+        ('dir', 'string'),
+        ('file', 'string'),
+        ('key', 'string'),
+        ('handle', 'int64'),
+        ('fields', 'string'),
+    ]
+    DICTIONARY_COLUMNS = ['type', 'host', 'user', 'process', 'action', 'dir', 'file', 'key']
+
+    def __init__(self, filename, compression='zstd'):
+        self.pyarrow, parquet = load_pyarrow()
+        self.names = [name for name, kind in self.COLUMNS]
+        self.types = [getattr(self.pyarrow, kind)() for name, kind in self.COLUMNS]
+        self.schema = self.pyarrow.schema([self.pyarrow.field(name, column_type)
+            for name, column_type in zip(self.names, self.types)])
+        self.writer = parquet.ParquetWriter(filename, self.schema, compression=compression,
+            use_dictionary=self.DICTIONARY_COLUMNS)
+        self.columns = dict((name, []) for name in self.names)
+        self.rows = 0
+
+    """
+    Add a batch of events given as the body of a POST: a JSON list of {type: {fields}}.
+    """
+    def write(self, data):
+        columns = self.columns
+        extra_columns = self.names[1:-1]
+        for event in json.loads(data):
+            for event_type, fields in event.iteritems():
+                columns['type'].append(event_type)
+                for name in extra_columns:
+                    columns[name].append(fields.pop(name, None))
+                columns['fields'].append(json.dumps(fields, separators=(',', ':')) if fields else None)
+                self.rows += 1
+        if self.rows >= self.ROW_GROUP_SIZE:
+            self.flush()
+
+    """
+    Write the buffered events out as a row group.
+    """
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = [self.pyarrow.array(self.columns[name], type=column_type)
+            for name, column_type in zip(self.names, self.types)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, names=self.names))
+        self.columns = dict((name, []) for name in self.names)
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+"""
+Read the events of a Parquet file written by ParquetEventWriter back as a pyarrow Table,
+memory-mapping the file and keeping the string columns dictionary encoded.
+"""
+def read_events(filename, columns=None):
+    pyarrow, parquet = load_pyarrow()
+    return parquet.read_table(filename, columns=columns, memory_map=True,
+        read_dictionary=[name for name in ParquetEventWriter.DICTIONARY_COLUMNS
+            if columns is None or name in columns])
@@ -0,0 +1,169 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from Queue import Queue
+from threading import Event, Thread
+import zlib
+
+'''Compressed output files written through a pipeline of background threads.
+Written data is cut into chunks that compressor threads turn into independent gzip members
+or zstd frames, which a writer thread appends to the file in order. Concatenated members
+and frames are valid gzip and zstd files, so the output decompresses with the usual tools.'''
+
+"""
+Returns the compression implied by the extension of filename: 'gzip', 'zstd' or None.
+"""
+def compression_for(filename):
+    if filename.endswith('.gz'):
+        return 'gzip'
+    if filename.endswith('.zst'):
+        return 'zstd'
+    return None
+
+"""
+Open filename for writing, compressing in the background if its extension asks for it.
+"""
+def open_output(filename, threads=2):
+    compression = compression_for(filename)
+    if compression:
+        return CompressedWriter(filename, compression, threads=threads)
+    return open(filename, 'w')
+
+"""
+Returns a function that compresses a string into one complete gzip member or zstd frame.
+Both zlib and zstandard release the GIL while compressing, so chunks compress in parallel;
+a zstd compressor must not be shared between threads.
+"""
+def chunk_compressor(compression, level=None):
+    if compression == 'gzip':
+        level = 6 if level is None else level
+        def compress(data):
+            # wbits 31 writes a gzip header and trailer around the deflate stream
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd output requires the zstandard package (pip install zstandard).')
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    raise ValueError('unknown compression: {0!r}'.format(compression))
+
+"""
+The CompressedWriter class is a write-only file that compresses on background threads.
+write() only buffers; every CHUNK_SIZE bytes are handed to the compressor threads, and the
+caller waits only when MAX_PENDING chunks are already queued for compression.
+"""
+class CompressedWriter:
+    CHUNK_SIZE = 1024 * 1024
+    MAX_PENDING = 16
+
+    def __init__(self, filename, compression, level=None, threads=2):
+        self.compression = compression
+        self.level = level
+        # Fail here rather than on a compressor thread if zstandard is missing
+        chunk_compressor(compression, level)
+        self.file = open(filename, 'wb')
+        self.buffer = []
+        self.buffered = 0
+        self.error = None
+        self.closed = False
+        # Chunks to compress, and their results in the order they must be written
+        self.work = Queue()
+        self.ordered = Queue(self.MAX_PENDING)
+        self.compressors = []
+        for i in range(max(1, threads)):
+            t = Thread(target=self.compress_loop)
+            t.daemon = True
+            t.start()
+            self.compressors.append(t)
+        self.writer = Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.CHUNK_SIZE:
+            self.submit()
+
+    """
+    Hand the buffered data to the compressors in chunks of CHUNK_SIZE.
+    """
+    def submit(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        for offset in xrange(0, len(data), self.CHUNK_SIZE):
+            slot = [None, Event()]
+            # Blocks while MAX_PENDING chunks are waiting
+            self.ordered.put(slot)
+            self.work.put((data[offset:offset + self.CHUNK_SIZE], slot))
+
+    def compress_loop(self):
+        compress = chunk_compressor(self.compression, self.level)
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            data, slot = item
+            try:
+                slot[0] = compress(data)
+            except Exception as e:
+                self.error = e
+                slot[0] = ''
+            slot[1].set()
+
+    def write_loop(self):
+        while True:
+            slot = self.ordered.get()
+            if slot is None:
+                return
+            slot[1].wait()
+            try:
+                self.file.write(slot[0])
+            except (IOError, OSError) as e:
+                self.error = e
+
+    def flush(self):
+        if self.buffered:
+            self.submit()
+
+    """
+    Compress whatever is buffered, wait for every chunk to be written and close the file.
+    """
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.ordered.put(None)
+        self.writer.join()
+        for t in self.compressors:
+            self.work.put(None)
+        for t in self.compressors:
+            t.join()
+        self.file.close()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
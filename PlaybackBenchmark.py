@@ -0,0 +1,328 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+from multiprocessing import Process, Value
+import os
+import platform
+import random
+from SocketServer import ThreadingMixIn
+import subprocess
+import sys
+from threading import Thread
+from time import sleep, time
+
+from SyntheticPlaybackEngine import EventQueue, HTTPSender, PlaybackEngine, list_templates
+from TemplateRandomizer import compiledTemplate, generateRandomData, templateRandomizer
+
+'''Benchmarks for the hot paths of the playback engine.
+Each section reports the best of several seeded runs; results are written as JSON so that
+runs from different versions can be compared with --compare.'''
+
+FIXED_TIME = 1400000000 # rebase every template to the same time so runs are comparable
+
+"""
+Run function repeat times and return the fastest run in seconds.
+"""
+def best_time(function, repeat):
+    best = None
+    for i in range(repeat):
+        started = time()
+        function()
+        elapsed = time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+"""
+Measure compiling each template and filling all of its events with
+templateRandomizer.next_event.
+"""
+def bench_randomizer(template_set, seed, repeat):
+    results = {}
+    for path in sorted(template_set):
+        compile_time = best_time(lambda: compiledTemplate(open(path, 'r')), repeat)
+        template = compiledTemplate(open(path, 'r'))
+        def fill():
+            randomizer = templateRandomizer(template, random.Random(seed))
+            randomizer.generate_test(FIXED_TIME)
+            while randomizer.next_event() is not None:
+                pass
+        fill_time = best_time(fill, repeat)
+        results[os.path.basename(path)] = {
+            'events': len(template),
+            'compile_seconds': compile_time,
+            'events_per_second': len(template) / fill_time,
+        }
+    return results
+
+"""
+Measure the cost per call of the generateRandomData helpers.
+PID and RID allocation is measured at increasing numbers of values already in use.
+"""
+def bench_generators(seed, repeat, calls=20000):
+    generator = generateRandomData(random.Random(seed))
+    results = {}
+    for name, call in [('randomString', generator.randomString),
+            ('randomSIDdomain', generator.randomSIDdomain)]:
+        results[name + '_us'] = best_time(lambda: [call() for i in xrange(calls)], repeat) / calls * 1e6
+    for occupancy in [0, 500, 1000, 2000]:
+        for name, new_allocator in [('randomPID', generator.pidAllocator),
+                ('randomRID', generator.ridAllocator)]:
+            def allocate():
+                allocator = new_allocator()
+                for i in xrange(occupancy):
+                    allocator.allocate()
+                started = time()
+                for i in xrange(100):
+                    allocator.allocate()
+                return time() - started
+            results['{0}_at_{1}_us'.format(name, occupancy)] = min(
+                allocate() for i in range(repeat)) / 100 * 1e6
+    return results
+
+"""
+Measure assembling batches from the networker's EventQueue with one producer thread,
+for events added one at a time and in slices, plus the cost of serializing a batch body.
+"""
+def bench_batching(template_set, seed, repeat, total=200000, batch_size=1000):
+    template = compiledTemplate(open(sorted(template_set)[0], 'r'))
+    randomizer = templateRandomizer(template, random.Random(seed))
+    randomizer.generate_test(FIXED_TIME)
+    sample = []
+    event = randomizer.next_event(bare=True)
+    while event is not None and len(sample) < 1000:
+        sample.append(event)
+        event = randomizer.next_event(bare=True)
+    events = (sample * (total // len(sample) + 1))[:total]
+
+    def assemble(slice_size):
+        queue = EventQueue(256 * 1024 * 1024)
+        def produce():
+            if slice_size == 1:
+                for event in events:
+                    queue.put(event)
+            else:
+                for i in xrange(0, total, slice_size):
+                    queue.put_many(events[i:i + slice_size])
+        producer = Thread(target=produce)
+        producer.start()
+        received = 0
+        while received < total:
+            batch = queue.get_batch(batch_size, 1)
+            received += len(batch)
+            queue.task_done(len(batch))
+        producer.join()
+
+    batch = events[:batch_size]
+    sender = HTTPSender('http://127.0.0.1/')
+    format_time = best_time(lambda: [list(sender.body_pieces(batch)) for i in xrange(100)], repeat) / 100
+    return {
+        'per_event_put_events_per_second': total / best_time(lambda: assemble(1), repeat),
+        'slice_put_events_per_second': total / best_time(lambda: assemble(100), repeat),
+        'format_batch_us': format_time * 1e6,
+    }
+
+"""
+A stand-in event manager that accepts keep-alive POSTs and counts the events received.
+"""
+class CountingListener(Process):
+    def __init__(self, port):
+        Process.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.events = Value('l', 0)
+        self.ready = Value('i', 0)
+
+    def run(self):
+        events = self.events
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with events.get_lock():
+                    events.value += body.count('}},{"') + 1
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        server = Server(('127.0.0.1', self.port), Handler)
+        self.ready.value = 1
+        server.serve_forever()
+
+"""
+Measure events per second through the whole engine against a local CountingListener
+for each number of simulated machines. The rate is taken from the start of the first
+request to the acknowledgement of the last, leaving out start-up and shutdown.
+"""
+def bench_end_to_end(template_dir, machine_counts, iterations, seed, port):
+    listener = CountingListener(port)
+    listener.start()
+    while not listener.ready.value:
+        sleep(0.01)
+    results = {}
+    stdout = sys.stdout
+    try:
+        for machines in machine_counts:
+            received = listener.events.value
+            sys.stdout = open(os.devnull, 'w')
+            engine = PlaybackEngine(template_dir, machines, iterations, 'http://127.0.0.1:{0}/'.format(port),
+                None, 0, False, stats_interval=0, seed=seed, start_time=FIXED_TIME)
+            started = time()
+            engine.start()
+            elapsed = time() - started
+            sys.stdout.close()
+            sys.stdout = stdout
+            sent = engine.metrics.batched_events
+            # Seconds from the first request sent to the last one acknowledged, if any completed
+            sending = None
+            if engine.metrics.first_sent is not None:
+                sending = engine.metrics.last_acknowledged - engine.metrics.first_sent
+            results[str(machines)] = {
+                'events': sent,
+                'received': listener.events.value - received,
+                'seconds': elapsed,
+                'sending_seconds': sending,
+                'events_per_second': sent / sending if sending else 0,
+            }
+    finally:
+        sys.stdout = stdout
+        listener.terminate()
+    return results
+
+"""
+Returns the numeric leaves of nested results as a flat dict of dotted names.
+"""
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, long, float)):
+            flat[name] = value
+    return flat
+
+"""
+Print each result next to the same result from a baseline file.
+"""
+def compare(baseline, results):
+    old = flatten(baseline['results'])
+    new = flatten(results['results'])
+    for name in sorted(set(old) & set(new)):
+        change = (new[name] - old[name]) / float(old[name]) * 100 if old[name] else 0
+        print '{0:<70} {1:>14.2f} {2:>14.2f} {3:>+8.1f}%'.format(name, old[name], new[name], change)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description='Benchmark the template randomizer, batching and end-to-end playback.')
+    parser.add_argument(
+        'templates',
+        nargs='?',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'),
+        help='The template or directory of templates to benchmark with. Defaults to templates/.')
+    parser.add_argument(
+        '--compare',
+        metavar='FILE',
+        help='Compare the results with an earlier results FILE.')
+    parser.add_argument(
+        '-i', '--iterations',
+        type=int,
+        metavar='NUM',
+        default=1,
+        help='Run through NUM templates per machine in the end-to-end benchmark.')
+    parser.add_argument(
+        '-m', '--machines',
+        metavar='LIST',
+        default='1,4,16',
+        help='Comma separated machine counts for the end-to-end benchmark.')
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='Write the results to FILE as JSON.')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=9901,
+        help='Local port for the stand-in listener.')
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        metavar='NUM',
+        default=3,
+        help='Report the best of NUM runs for each measurement.')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='Seed for the random number generator.')
+    parser.add_argument(
+        '--sections',
+        default='randomizer,generators,batching,end_to_end',
+        help='Comma separated sections to run.')
+    args = parser.parse_args()
+
+    template_dir = os.path.abspath(args.templates)
+    template_set = list_templates(template_dir)
+    sections = args.sections.split(',')
+    results = {
+        'meta': {
+            'time': time(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'templates': sorted(os.path.basename(path) for path in template_set),
+        },
+        'results': {},
+    }
+    if 'randomizer' in sections:
+        print 'Benchmarking templateRandomizer.next_event...'
+        results['results']['randomizer'] = bench_randomizer(template_set, args.seed, args.repeat)
+    if 'generators' in sections:
+        print 'Benchmarking generateRandomData...'
+        results['results']['generators'] = bench_generators(args.seed, args.repeat)
+    if 'batching' in sections:
+        print 'Benchmarking batch assembly...'
+        results['results']['batching'] = bench_batching(template_set, args.seed, args.repeat)
+    if 'end_to_end' in sections:
+        print 'Benchmarking end-to-end playback...'
+        machine_counts = [int(count) for count in args.machines.split(',')]
+        results['results']['end_to_end'] = bench_end_to_end(template_dir, machine_counts,
+            args.iterations, args.seed, args.port)
+
+    for name, value in sorted(flatten(results['results']).items()):
+        print '{0:<70} {1:>14.2f}'.format(name, value)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print '\nCompared with {0}:'.format(args.compare)
+            compare(json.load(baseline_file), results)
@@ -0,0 +1,288 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import bisect
+import json
+from threading import Event, Lock, Thread
+from time import time
+
+'''Throughput and latency instrumentation for the playback engine.
+Generators, the networker and the sender record into a shared PlaybackMetrics object;
+a MetricsReporter prints a summary periodically and can export snapshots as JSON lines
+or serve them as Prometheus text.'''
+
+"""
+The PlaybackMetrics class holds the counters of a playback run.
+Updates are made per slice, batch or request rather than per event, so a single lock
+is cheap enough.
+"""
+class PlaybackMetrics:
+    # Upper bounds of the POST latency buckets in milliseconds
+    LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time()
+        self.generated = {} # worker name -> events generated
+        self.batches = 0
+        self.batched_events = 0
+        self.min_batch = None
+        self.max_batch = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.endpoint_requests = {} # URL -> completed POST requests
+        self.first_sent = None # time the earliest completed request was started
+        self.last_acknowledged = None # time the latest request completed
+        self.queue_depth = lambda: 0
+        self.endpoint_health = lambda: {} # URL -> whether the endpoint is taking requests
+
+    def record_generated(self, worker, count):
+        with self.lock:
+            self.generated[worker] = self.generated.get(worker, 0) + count
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_events += size
+            self.max_batch = max(self.max_batch, size)
+            if self.min_batch is None or size < self.min_batch:
+                self.min_batch = size
+
+    """
+    Record a completed POST of size bytes to endpoint that took latency seconds.
+    """
+    def record_request(self, size, latency, endpoint=None):
+        milliseconds = latency * 1000
+        now = time()
+        with self.lock:
+            if self.first_sent is None or now - latency < self.first_sent:
+                self.first_sent = now - latency
+            self.last_acknowledged = now
+            self.requests += 1
+            if endpoint is not None:
+                self.endpoint_requests[endpoint] = self.endpoint_requests.get(endpoint, 0) + 1
+            self.bytes_sent += size
+            self.latency_sum += milliseconds
+            self.latency_counts[bisect.bisect_left(self.LATENCY_BUCKETS, milliseconds)] += 1
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    """
+    Returns the latency in milliseconds below which the given fraction of requests
+    completed, as the upper bound of the matching bucket, or None if it is beyond the
+    largest bucket.
+    """
+    def latency_percentile(self, counts, fraction):
+        total = sum(counts)
+        if not total:
+            return 0
+        target = total * fraction
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= target:
+                if i < len(self.LATENCY_BUCKETS):
+                    return self.LATENCY_BUCKETS[i]
+                return None
+        return None
+
+    """
+    Returns a copy of every counter as a dict.
+    """
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time(),
+                'elapsed': time() - self.start,
+                'generated': dict(self.generated),
+                'queue_depth': self.queue_depth(),
+                'batches': self.batches,
+                'batched_events': self.batched_events,
+                'min_batch': self.min_batch or 0,
+                'max_batch': self.max_batch,
+                'requests': self.requests,
+                'endpoint_requests': dict(self.endpoint_requests),
+                'endpoints_up': self.endpoint_health(),
+                'bytes_sent': self.bytes_sent,
+                'retries': self.retries,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'latency_buckets_ms': list(self.LATENCY_BUCKETS),
+                'latency_counts': list(self.latency_counts),
+                'latency_sum_ms': self.latency_sum,
+            }
+
+    """
+    Returns the rates between two snapshots, per second.
+    """
+    def rates(self, previous, current):
+        interval = max(current['time'] - previous['time'], 1e-6)
+        generated = {}
+        for worker, count in current['generated'].items():
+            generated[worker] = (count - previous['generated'].get(worker, 0)) / interval
+        requests = current['requests'] - previous['requests']
+        batches = current['batches'] - previous['batches']
+        latency_counts = [c - p for c, p in zip(current['latency_counts'], previous['latency_counts'])]
+        return {
+            'interval': interval,
+            'generated_per_second': generated,
+            'events_generated_per_second': sum(generated.values()),
+            'events_sent_per_second': (current['batched_events'] - previous['batched_events']) / interval,
+            'requests_per_second': requests / interval,
+            'bytes_per_second': (current['bytes_sent'] - previous['bytes_sent']) / interval,
+            'mean_batch': (current['batched_events'] - previous['batched_events']) / float(batches) if batches else 0,
+            'mean_latency_ms': (current['latency_sum_ms'] - previous['latency_sum_ms']) / requests if requests else 0,
+            'p50_latency_ms': self.latency_percentile(latency_counts, 0.5),
+            'p99_latency_ms': self.latency_percentile(latency_counts, 0.99),
+        }
+
+    """
+    Returns the counters in the Prometheus text exposition format.
+    """
+    def prometheus(self):
+        current = self.snapshot()
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP playback_{0} {1}'.format(name, help_text))
+            lines.append('# TYPE playback_{0} {1}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('playback_{0}{1} {2}'.format(name, labels, value))
+        metric('events_generated_total', 'counter', 'Events generated per worker.',
+            [('{{worker="{0}"}}'.format(worker), count) for worker, count in sorted(current['generated'].items())])
+        metric('send_queue_depth', 'gauge', 'Events waiting in the send queue.', [('', current['queue_depth'])])
+        metric('batches_total', 'counter', 'Batches handed to the sender.', [('', current['batches'])])
+        metric('batched_events_total', 'counter', 'Events in batches handed to the sender.', [('', current['batched_events'])])
+        metric('requests_total', 'counter', 'Completed POST requests.', [('', current['requests'])])
+        metric('endpoint_requests_total', 'counter', 'Completed POST requests per endpoint.',
+            [('{{endpoint="{0}"}}'.format(url), count) for url, count in sorted(current['endpoint_requests'].items())])
+        metric('endpoint_up', 'gauge', 'Whether the endpoint is taking requests.',
+            [('{{endpoint="{0}"}}'.format(url), int(up)) for url, up in sorted(current['endpoints_up'].items())])
+        metric('bytes_sent_total', 'counter', 'Bytes of POST bodies sent.', [('', current['bytes_sent'])])
+        metric('retries_total', 'counter', 'POST requests retried after a connection failure.', [('', current['retries'])])
+        metric('errors_total', 'counter', 'POST requests answered with an error status.', [('', current['errors'])])
+        metric('timeouts_total', 'counter', 'POST requests that got no response in time.', [('', current['timeouts'])])
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(current['latency_buckets_ms'] + ['+Inf'], current['latency_counts']):
+            cumulative += count
+            buckets.append(('{{le="{0}"}}'.format(bound), cumulative))
+        metric('post_latency_ms', 'histogram', 'POST latency in milliseconds.', [])
+        for labels, value in buckets:
+            lines.append('playback_post_latency_ms_bucket{0} {1}'.format(labels, value))
+        lines.append('playback_post_latency_ms_sum {0}'.format(current['latency_sum_ms']))
+        lines.append('playback_post_latency_ms_count {0}'.format(cumulative))
+        return '\n'.join(lines) + '\n'
+
+"""
+The MetricsReporter class prints a summary of the metrics every interval seconds and
+optionally appends each snapshot to a JSON lines file and serves the metrics as
+Prometheus text on a local port.
+"""
+class MetricsReporter(Thread):
+    def __init__(self, metrics, interval=10, stats_file=None, port=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.interval = interval
+        self.stats_file = open(stats_file, 'a') if stats_file else None
+        self.server = None
+        if port:
+            self.server = HTTPServer(('127.0.0.1', port), self.handler())
+            server_thread = Thread(target=self.server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+        self.stopped = Event()
+        self.previous = metrics.snapshot()
+
+    def handler(self):
+        metrics = self.metrics
+        class PrometheusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return PrometheusHandler
+
+    def run(self):
+        # An interval of 0 only serves the Prometheus endpoint
+        if not self.interval:
+            return
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    """
+    Print the rates since the last report if printing is enabled and append the snapshot
+    to the stats file if there is one.
+    """
+    def report(self):
+        current = self.metrics.snapshot()
+        rates = self.metrics.rates(self.previous, current)
+        self.previous = current
+        if self.interval:
+            self.print_summary(current, rates)
+        if self.stats_file:
+            current.update(rates)
+            self.stats_file.write(json.dumps(current) + '\n')
+            self.stats_file.flush()
+
+    def print_summary(self, current, rates):
+        p99 = rates['p99_latency_ms']
+        if p99 is None:
+            p99 = '>{0}'.format(self.metrics.LATENCY_BUCKETS[-1])
+        print ('Stats: generated {0:.0f} ev/s, sent {1:.0f} ev/s, queue {2}, batch {3:.0f} avg, '
+            '{4:.1f} req/s, {5:.2f} MB/s, latency {6:.1f} ms avg {7} ms p99, '
+            '{8} retries, {9} errors, {10} timeouts').format(
+            rates['events_generated_per_second'], rates['events_sent_per_second'],
+            current['queue_depth'], rates['mean_batch'], rates['requests_per_second'],
+            rates['bytes_per_second'] / (1024 * 1024), rates['mean_latency_ms'],
+            p99, current['retries'], current['errors'], current['timeouts'])
+
+    """
+    Write a final report, to the stats file even when printing is disabled, and stop.
+    """
+    def close(self):
+        self.stopped.set()
+        # Let the reporting thread exit before interpreter shutdown tears down its wait
+        if self.is_alive():
+            self.join()
+        if self.interval or self.stats_file:
+            self.report()
+        if self.stats_file:
+            self.stats_file.close()
+            self.stats_file = None
+        if self.server:
+            self.server.shutdown()
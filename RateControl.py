@@ -0,0 +1,169 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from argparse import ArgumentTypeError
+import math
+from threading import Lock
+from time import sleep, time
+
+'''Rate control for the playback engine: a token bucket paced by a rate schedule.
+A schedule maps the seconds elapsed since playback started to a target rate in events
+per second.'''
+
+"""
+Send at the same rate for the whole run.
+"""
+class ConstantRate:
+    def __init__(self, rate):
+        self.value = float(rate)
+
+    def rate(self, elapsed):
+        return self.value
+
+    def __str__(self):
+        return '{0:g} events/s'.format(self.value)
+
+"""
+Move linearly from start to end over duration seconds, then hold end.
+"""
+class RampRate:
+    def __init__(self, start, end, duration):
+        self.start = float(start)
+        self.end = float(end)
+        self.duration = float(duration)
+
+    def rate(self, elapsed):
+        if elapsed >= self.duration:
+            return self.end
+        return self.start + (self.end - self.start) * elapsed / self.duration
+
+    def __str__(self):
+        return 'ramp from {0:g} to {1:g} events/s over {2:g}s'.format(self.start, self.end, self.duration)
+
+"""
+Switch to each rate once its start time has passed; steps is a list of (start, rate).
+"""
+class StepRate:
+    def __init__(self, steps):
+        self.steps = sorted((float(start), float(rate)) for start, rate in steps)
+
+    def rate(self, elapsed):
+        current = 0.0
+        for start, rate in self.steps:
+            if elapsed < start:
+                break
+            current = rate
+        return current
+
+    def __str__(self):
+        return 'steps of ' + ', '.join('{0:g} events/s at {1:g}s'.format(rate, start)
+            for start, rate in self.steps)
+
+"""
+Oscillate around mean by amplitude with a period in seconds; never drops below 0.
+"""
+class SineRate:
+    def __init__(self, mean, amplitude, period):
+        self.mean = float(mean)
+        self.amplitude = float(amplitude)
+        self.period = float(period)
+
+    def rate(self, elapsed):
+        return max(0.0, self.mean + self.amplitude * math.sin(2 * math.pi * elapsed / self.period))
+
+    def __str__(self):
+        return 'sine of {0:g} +/- {1:g} events/s every {2:g}s'.format(self.mean, self.amplitude, self.period)
+
+"""
+The TokenBucket class paces events to a rate schedule.
+Tokens accrue continuously at the scheduled rate up to capacity, so senders are released
+smoothly within each second instead of in one burst per second.
+"""
+class TokenBucket:
+    MAX_SLEEP = 0.1 # seconds; re-read the schedule at least this often while waiting
+
+    def __init__(self, schedule, capacity):
+        self.schedule = schedule
+        self.capacity = float(capacity)
+        self.tokens = 0.0
+        self.lock = Lock()
+        self.start = None
+        self.last = None
+
+    """
+    Returns the scheduled rate at this moment.
+    """
+    def current_rate(self):
+        if self.start is None:
+            return self.schedule.rate(0)
+        return self.schedule.rate(time() - self.start)
+
+    """
+    Block until count tokens are available and take them.
+    Requests larger than the capacity wait for a full bucket and leave it in debt,
+    so the average rate still holds.
+    """
+    def acquire(self, count):
+        with self.lock:
+            if self.start is None:
+                self.start = self.last = time()
+            needed = min(float(count), self.capacity)
+            while True:
+                now = time()
+                rate = self.schedule.rate(now - self.start)
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * rate)
+                self.last = now
+                if self.tokens >= needed:
+                    self.tokens -= count
+                    return
+                if rate > 0:
+                    sleep(min((needed - self.tokens) / rate, self.MAX_SLEEP))
+                else:
+                    sleep(self.MAX_SLEEP)
+
+"""
+Parse a rate schedule given on the command line:
+    ramp:START:END:SECONDS
+    step:RATE@SECONDS[,RATE@SECONDS...]
+    sine:MEAN:AMPLITUDE:PERIOD
+    RATE
+"""
+def parse_rate_schedule(spec):
+    kind, _, params = spec.partition(':')
+    try:
+        if not params:
+            schedule = ConstantRate(kind)
+            if schedule.value <= 0:
+                raise ValueError
+            return schedule
+        if kind == 'ramp':
+            start, end, duration = params.split(':')
+            if float(duration) <= 0:
+                raise ValueError
+            return RampRate(start, end, duration)
+        if kind == 'step':
+            steps = []
+            for step in params.split(','):
+                rate, start = step.split('@')
+                steps.append((start, rate))
+            return StepRate(steps)
+        if kind == 'sine':
+            mean, amplitude, period = params.split(':')
+            if float(period) <= 0:
+                raise ValueError
+            return SineRate(mean, amplitude, period)
+    except ValueError:
+        pass
+    raise ArgumentTypeError('invalid rate schedule: {0!r}'.format(spec))
@@ -14,33 +14,77 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from argparse import ArgumentParser
+from collections import deque
+import heapq
+import httplib
+import itertools
+from multiprocessing import cpu_count, Event as ProcessEvent, Process, Queue as ProcessQueue
 import os
-from Queue import Queue
+from Queue import Empty, Queue
 import random
-from threading import Lock, Thread, Timer
-from time import sleep
-import urllib2
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+from threading import Condition, Lock, Thread
+from time import sleep, time
+import urlparse
+import zlib
 
-from TemplateRandomizer import templateRandomizer
+from CompressedOutput import chunk_compressor, compression_for, open_output
+from ColumnarOutput import ParquetEventWriter, load_pyarrow
+from PlaybackMetrics import MetricsReporter, PlaybackMetrics
+from RateControl import ConstantRate, TokenBucket, parse_rate_schedule
+from TemplateRandomizer import AllocationError, compiledTemplate, templateRandomizer
 
 """
 The PlaybackEngine class simulates multiple computers, generating synthetic system events
 and sends them to a server via HTTP POST.
 """
 class PlaybackEngine:
-    def __init__(self, template, machines, iterations, url, output_file, rate, debug):
-        self.networker = NetworkingWorker(url, output_file, rate, debug)
+    def __init__(self, template, machines, iterations, url, output_file, rate, debug, cache_size=1024,
+            processes=1, connections=4, timeout=10, batch_size=0, speed=0, executors=4,
+            stats_interval=10, stats_file=None, stats_port=None, key_files=False, output_format='json',
+            seed=None, start_time=None, chunked=False, queue_memory=256, spill_dir=None,
+            balance='round-robin'):
+        self.metrics = PlaybackMetrics()
+        self.reporter = None
+        if stats_interval or stats_file or stats_port:
+            self.reporter = MetricsReporter(self.metrics, stats_interval, stats_file, stats_port)
+        self.networker = NetworkingWorker(url, output_file, rate, debug, connections, timeout, batch_size,
+            self.metrics, output_format, chunked, queue_memory, spill_dir, balance)
         self.template = template
         self.template_worker_list = []
-        self.file_lock = Lock()
+        self.template_cache = TemplateCache(cache_size * 1024 * 1024)
         self.max_workers = machines
         self.iterations = iterations
         self.debug = debug
-        random.seed()
+        self.relay = None
+        self.replay = None
+        if speed:
+            # Replayed events are due when released; do not hold them back to fill batches
+            self.networker.batch_wait = ReplayScheduler.TICK
+        self.seed = new_seed() if seed is None else seed
 
-        # Spawn machines # of threads
-        while self.active_workers() < self.max_workers:
-            self.spawn_worker()
+        if processes > 1:
+            # Shard the machines across generator processes that report back to the networker
+            event_queue = ProcessQueue(GeneratorProcess.QUEUE_CHUNKS)
+            for shard in range(min(processes, machines)):
+                self.template_worker_list.append(GeneratorProcess(shard,
+                    range(shard, machines, processes), template, iterations, event_queue,
+                    debug, cache_size, speed, executors, key_files, self.seed, start_time))
+            self.relay = EventRelay(event_queue, list(self.template_worker_list),
+                self.networker.add_events_to_batch, self.worker_callback, self.metrics)
+        else:
+            if speed:
+                self.replay = ReplayScheduler(self.networker.add_events_to_batch, speed)
+            # Multiplex the machines over a fixed pool of executor threads
+            template_set = list_templates(template)
+            hosts = [SimulatedHost(host_id, template_set, self.template_cache, iterations, debug,
+                self.replay, key_files, self.seed, start_time) for host_id in xrange(machines)]
+            self.template_worker_list.append(HostScheduler(hosts, executors,
+                lambda: self.networker.add_events_to_batch, self.worker_callback, self.metrics))
 
     """
     Stop all running worker threads and the networker thread.
@@ -49,9 +93,11 @@ class PlaybackEngine:
     """
     def stop(self):
         print "Killing all workers."
-        for t in self.template_worker_list:
+        for t in list(self.template_worker_list):
             if t.is_alive():
                 t.close()
+        if self.replay:
+            self.replay.close()
         if self.iterations != 0:
             if self.networker.is_alive():
                 self.networker.close()
@@ -63,39 +109,41 @@ class PlaybackEngine:
             except KeyboardInterrupt:
                 if self.networker.is_alive():
                     self.networker.close()
+        if self.reporter:
+            self.reporter.close()
 
     """
-    Starts the initial worker threads and then spawns more as needed.
+    Starts the host scheduler or generator processes and waits for them to finish.
     User may quit at any time by pressing Ctrl-C.
     """
     def start(self):
-        print "Starting playback engine."
+        print "Starting playback engine with seed {0}.".format(self.seed)
         try:
+            if self.reporter:
+                self.reporter.start()
             self.networker.start()
-            for t in self.template_worker_list:
+            if self.relay:
+                self.relay.start()
+            if self.replay:
+                self.replay.start()
+            for t in list(self.template_worker_list):
                 t.start()
 
             # Wait for all the workers to finish
             while self.active_workers():
                 sleep(0.5)
+            # Wait for the remaining events to be released
+            if self.replay:
+                self.replay.finish_then_close()
             # Wait for the networking thread to finish sends
             self.networker.finish_then_close()
+            if self.reporter:
+                self.reporter.close()
 
         except KeyboardInterrupt:
             # Listen for a keyboard interrupt and stop when given
             self.stop()
 
-    """
-    Creates a new worker thread and adds it to the worker list.
-    Increments the current iteration of the template that we're on
-    """
-    def spawn_worker(self):
-        new_worker = TemplateWorker(len(self.template_worker_list),
-            self.template, self.file_lock, self.iterations, self.networker.add_event_to_batch,
-            self.debug, self.worker_callback)
-        self.template_worker_list.append(new_worker)
-        return new_worker
-
     """
     Returns the number of workers that have been created but not finished
     """
@@ -107,104 +155,747 @@ class PlaybackEngine:
     """
     def worker_callback(self, worker):
         self.template_worker_list.remove(worker)
+        if not self.template_worker_list:
+            # Every event has been queued; send partial batches without waiting for more
+            self.networker.drain()
+
+"""
+The GeneratorProcess class runs a HostScheduler for a shard of the simulated hosts in
+a separate process, so that generation is not bound to a single core.
+Events are passed back to the engine over a process queue in chunks of CHUNK_SIZE to keep
+the cost of pickling and pipe writes per event low.
+"""
+class GeneratorProcess(Process):
+    CHUNK_SIZE = 1000
+    QUEUE_CHUNKS = 300 # maxsize = 300k events, the same as the networker's send queue
+
+    def __init__(self, shard, host_ids, template, iterations, event_queue, debug, cache_size, speed=0,
+            executors=4, key_files=False, seed=None, start_time=None):
+        Process.__init__(self)
+        self.daemon = True
+        self.shard = shard
+        self.host_ids = host_ids
+        self.template = template
+        self.iterations = iterations
+        self.event_queue = event_queue
+        self.debug = debug
+        self.cache_size = cache_size
+        self.speed = speed
+        self.executors = executors
+        self.key_files = key_files
+        self.seed = seed
+        self.start_time = start_time
+        self.stop_event = ProcessEvent()
+
+    def run(self):
+        # The engine handles Ctrl-C and asks the shard to stop through stop_event
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        template_cache = TemplateCache(self.cache_size * 1024 * 1024)
+        replay = None
+        if self.speed:
+            # Released events are due now, so pass them on without waiting for a full chunk
+            replay = ReplayScheduler(self.put_events, self.speed)
+            replay.start()
+        chunkers = []
+        def new_chunker():
+            chunker = EventChunker(self.event_queue, self.shard, self.CHUNK_SIZE)
+            chunkers.append(chunker)
+            return chunker.add_events
+        template_set = list_templates(self.template)
+        hosts = [SimulatedHost(host_id, template_set, template_cache, self.iterations, self.debug,
+            replay, self.key_files, self.seed, self.start_time) for host_id in self.host_ids]
+        scheduler = HostScheduler(hosts, self.executors, new_chunker)
+        scheduler.start()
+        while scheduler.is_alive():
+            if self.stop_event.is_set():
+                scheduler.close()
+                if replay:
+                    replay.close()
+            self.stop_event.wait(0.5)
+        if replay:
+            replay.finish_then_close()
+        for chunker in chunkers:
+            chunker.flush()
+        # Let the engine know that this shard is done
+        self.event_queue.put((self.shard, None))
+
+    def put_events(self, events):
+        self.event_queue.put((self.shard, events))
+
+    """
+    Send a signal for the shard to stop.
+    """
+    def close(self):
+        self.stop_event.set()
+
+"""
+The EventChunker class collects the events of a single executor and puts them on a
+process queue in chunks.
+"""
+class EventChunker:
+    def __init__(self, event_queue, shard, chunk_size):
+        self.event_queue = event_queue
+        self.shard = shard
+        self.chunk_size = chunk_size
+        self.chunk = []
+
+    def add_events(self, events):
+        self.chunk.extend(events)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            self.event_queue.put((self.shard, self.chunk))
+            self.chunk = []
+
+"""
+The EventRelay class moves event chunks from the generator processes to the networker
+and reports each process to the engine once it has finished.
+"""
+class EventRelay(Thread):
+    def __init__(self, event_queue, processes, output_call, callback, metrics):
+        Thread.__init__(self)
+        self.daemon = True
+        self.event_queue = event_queue
+        self.processes = dict((p.shard, p) for p in processes)
+        self.output_call = output_call
+        self.callback = callback
+        self.metrics = metrics
+
+    def run(self):
+        while self.processes:
+            try:
+                shard, events = self.event_queue.get(True, 1)
+            except Empty:
+                # A process that died without reporting back will never send its marker
+                for shard, p in self.processes.items():
+                    if p.exitcode is not None:
+                        self.finish(shard)
+                continue
+            if events is None:
+                self.finish(shard)
+            else:
+                self.metrics.record_generated('process-{0}'.format(shard), len(events))
+                self.output_call(events)
+
+    def finish(self, shard):
+        p = self.processes.pop(shard, None)
+        if p is not None:
+            self.callback(p)
+
+"""
+The BulkEngine class generates events straight into files, without a networker, to build
+datasets as fast as possible. The machines are split into shards, each written to its own
+output file, and the shards are divided among BulkGenerator processes. A shard's file only
+depends on the seed, start time, machines, iterations and number of shards, not on the
+number of processes.
+"""
+class BulkEngine:
+    def __init__(self, template, machines, iterations, output_file, output_format='json', processes=1,
+            seed=None, debug=False, cache_size=1024, key_files=False, shards=None, start_time=None):
+        self.seed = new_seed() if seed is None else seed
+        self.results = ProcessQueue()
+        shards = max(1, min(shards or processes, machines))
+        shard_list = [(shard, range(shard, machines, shards), shard_filename(output_file, shard, shards))
+            for shard in range(shards)]
+        self.shards = shards
+        self.generators = [BulkGenerator(shard_list[worker::processes], template, iterations, output_format,
+            self.seed, start_time, self.results, debug, cache_size, key_files)
+            for worker in range(min(processes, shards))]
+
+    """
+    Start the generator processes and wait for every shard to be written.
+    User may quit at any time by pressing Ctrl-C; the files written so far are closed cleanly.
+    """
+    def start(self):
+        print "Generating events into {0} shard(s) on {1} process(es) with seed {2}.".format(
+            self.shards, len(self.generators), self.seed)
+        started = time()
+        self.total = 0
+        self.remaining = self.shards
+        try:
+            for g in self.generators:
+                g.start()
+            self.collect()
+        except KeyboardInterrupt:
+            self.stop()
+            self.collect()
+        elapsed = time() - started
+        print "Generated {0} events in {1:.1f} seconds ({2:.0f} events/s).".format(
+            self.total, elapsed, self.total / max(elapsed, 1e-6))
+
+    """
+    Wait for the remaining shards to report how many events they wrote.
+    """
+    def collect(self):
+        while self.remaining:
+            try:
+                shard, filename, count = self.results.get(True, 0.5)
+            except Empty:
+                if not any(g.is_alive() for g in self.generators) and self.results.empty():
+                    print 'A generator process stopped unexpectedly.'
+                    return
+                continue
+            print "Shard {0} wrote {1} events to {2}.".format(shard, count, filename)
+            self.total += count
+            self.remaining -= 1
+
+    """
+    Ask every generator to stop; each closes its output file before reporting back.
+    """
+    def stop(self):
+        print "Stopping all generators."
+        for g in self.generators:
+            g.close()
+
+"""
+Returns the output file for a shard: events.json.gz becomes events-002.json.gz.
+"""
+def shard_filename(filename, shard, shards):
+    if shards == 1:
+        return filename
+    directory, name = os.path.split(filename)
+    base, dot, extensions = name.partition('.')
+    return os.path.join(directory, '{0}-{1:03d}{2}{3}'.format(base, shard, dot, extensions))
+
+"""
+Returns a seed for runs that were not given one.
+"""
+def new_seed():
+    return random.SystemRandom().randint(0, 2 ** 31)
+
+"""
+The BulkGenerator class writes shards of the simulated hosts to files, one shard after
+another. The hosts of a shard take turns of HostScheduler.QUANTUM events on a single thread
+so that the file does not depend on thread timing. Events are written CHUNK_SIZE at a time
+as JSON lists, each ended like a request body plus a newline, in the same format as the
+networker's output file.
+"""
+class BulkGenerator(Process):
+    CHUNK_SIZE = 1000
+    CHUNK_END = ']\r\n\n' # NetworkingWorker.send_batch ends each batch the same way
+
+    """
+    shards is a list of (shard, host ids, filename).
+    """
+    def __init__(self, shards, template, iterations, output_format, seed, start_time, results,
+            debug=False, cache_size=1024, key_files=False):
+        Process.__init__(self)
+        self.daemon = True
+        self.shards = shards
+        self.template = template
+        self.iterations = iterations
+        self.output_format = output_format
+        self.seed = seed
+        self.start_time = start_time
+        self.results = results
+        self.debug = debug
+        self.cache_size = cache_size
+        self.key_files = key_files
+        self.stop_event = ProcessEvent()
+
+    def run(self):
+        # The engine handles Ctrl-C and asks the generator to stop through stop_event
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        template_cache = TemplateCache(self.cache_size * 1024 * 1024)
+        template_set = list_templates(self.template)
+        for shard, host_ids, filename in self.shards:
+            hosts = deque(SimulatedHost(host_id, template_set, template_cache, self.iterations, self.debug,
+                None, self.key_files, self.seed, self.start_time) for host_id in host_ids)
+            count = self.write_shard(hosts, filename)
+            self.results.put((shard, filename, count))
+
+    """
+    Generate the events of hosts into filename. Returns the number of events written.
+    """
+    def write_shard(self, hosts, filename):
+        if self.output_format == 'parquet':
+            output = ParquetEventWriter(filename)
+        else:
+            output = open_output(filename)
+        events = []
+        count = 0
+        stopping = False
+        try:
+            while hosts:
+                if not stopping and self.stop_event.is_set():
+                    # Stopped hosts finish on their next turn
+                    stopping = True
+                    for host in hosts:
+                        host.close()
+                host = hosts.popleft()
+                state, generated = host.run_slice(HostScheduler.QUANTUM, events, None)
+                if state == SimulatedHost.RUNNING:
+                    hosts.append(host)
+                if len(events) >= self.CHUNK_SIZE:
+                    output.write('[' + ','.join(events) + self.CHUNK_END)
+                    count += len(events)
+                    events = []
+            if events:
+                output.write('[' + ','.join(events) + self.CHUNK_END)
+                count += len(events)
+        finally:
+            output.close()
+        return count
+
+    """
+    Send a signal for the generator to stop.
+    """
+    def close(self):
+        self.stop_event.set()
 
 """
-The TemplateWorker class reads in synthetic events from a file and passes the events
-to the NetworkingWorker. Spawns as a separate thread.
+The ReplayScheduler class releases events at their template timestamps, scaled by speed,
+for every simulated machine from a single timer heap.
+Hosts hand over events up to LOOKAHEAD seconds before they are due. A host that gets
+further ahead is parked in the heap and resumed once the scheduler's clock catches up,
+so no executor waits on a single host.
 """
-class TemplateWorker(Thread):
-    def __init__(self, id, template_dir, file_lock, iterations, output_call, debug, callback=None):
+class ReplayScheduler(Thread):
+    TIME_UNIT = 1.0 / compiledTemplate.TIME_UNITS # seconds per unit of template time
+    LOOKAHEAD = 0.5 # seconds
+    TICK = 0.01 # seconds; upper bound on how late an event is released
+
+    def __init__(self, output_call, speed=1.0):
         Thread.__init__(self)
+        self.daemon = True
+        self.output_call = output_call
+        self.speed = float(speed)
+        self.lock = Lock()
+        self.events = [] # heap of (release time, sequence, event)
+        self.waiters = [] # heap of (release time, sequence, resume callback)
+        self.sequence = itertools.count()
+        self.horizon = time() + self.LOOKAHEAD
+        self.stop = False
+
+    """
+    Returns the wall clock time at which an event offset template milliseconds after
+    template_start should be released.
+    """
+    def release_time(self, template_start, offset):
+        return template_start + offset * self.TIME_UNIT / self.speed
+
+    """
+    Queue an event for release at the given wall clock time and return True.
+    If the release time is beyond the scheduler's lookahead, the event is not queued;
+    resume is called once it is within reach and False is returned.
+    """
+    def schedule(self, event, release, resume):
+        with self.lock:
+            if self.stop:
+                return True
+            if release > self.horizon:
+                heapq.heappush(self.waiters, (release, next(self.sequence), resume))
+                return False
+            heapq.heappush(self.events, (release, next(self.sequence), event))
+            return True
+
+    def run(self):
+        while not self.stop:
+            now = time()
+            due = []
+            resumed = []
+            with self.lock:
+                self.horizon = now + self.LOOKAHEAD
+                while self.waiters and self.waiters[0][0] <= self.horizon:
+                    resumed.append(heapq.heappop(self.waiters)[2])
+                while self.events and self.events[0][0] <= now:
+                    due.append(heapq.heappop(self.events)[2])
+                next_release = self.events[0][0] if self.events else now + self.TICK
+            for resume in resumed:
+                resume()
+            if due:
+                self.output_call(due)
+            else:
+                sleep(min(max(next_release - now, 0), self.TICK))
+
+    """
+    Returns True while events are waiting to be released.
+    """
+    def pending(self):
+        return len(self.events) > 0 or len(self.waiters) > 0
+
+    """
+    Wait for every scheduled event to be released, then stop.
+    """
+    def finish_then_close(self):
+        while self.pending() and not self.stop:
+            sleep(self.TICK)
+        self.close()
+
+    """
+    Stop releasing events and resume any parked hosts so that they can finish.
+    """
+    def close(self):
+        with self.lock:
+            self.stop = True
+            waiters = self.waiters
+            self.waiters = []
+        for waiter in waiters:
+            waiter[2]()
+
+"""
+The TemplateCache class keeps compiled templates in memory so that they are read and
+compiled once per process and shared by every SimulatedHost.
+Lookups of cached templates take no lock; the least recently used templates are evicted
+once the estimated memory of the compiled templates exceeds max_bytes.
+"""
+class TemplateCache:
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes # 0 means unlimited
+        self.templates = {} # path -> (compiled template, estimated bytes in memory)
+        self.last_used = {} # path -> tick of the most recent lookup
+        self.ticks = itertools.count()
+        self.load_locks = {}
+        self.insert_lock = Lock()
+        self.size = 0
+
+    """
+    Returns the compiled template for path, loading it if it is not cached.
+    Raises IOError or ValueError if the template cannot be read or compiled.
+    """
+    def get(self, path):
+        entry = self.templates.get(path)
+        if entry is None:
+            entry = self.load(path)
+        self.last_used[path] = next(self.ticks)
+        return entry[0]
+
+    """
+    Compile a template, holding a lock for that path only so that concurrent
+    misses on the same template load it once.
+    """
+    def load(self, path):
+        with self.load_locks.setdefault(path, Lock()):
+            entry = self.templates.get(path)
+            if entry is not None:
+                return entry
+            template = compiledTemplate(open(path, 'r'))
+            entry = (template, template.size)
+            with self.insert_lock:
+                self.templates[path] = entry
+                self.last_used[path] = next(self.ticks)
+                self.size += entry[1]
+                self.evict(path)
+        return entry
+
+    """
+    Drop least recently used templates until the cache fits max_bytes, keeping the
+    template that was just loaded. Workers holding an evicted template keep using it.
+    """
+    def evict(self, keep):
+        while self.max_bytes and self.size > self.max_bytes and len(self.templates) > 1:
+            victim = min((path for path in self.templates if path != keep),
+                key=lambda path: self.last_used.get(path, -1))
+            self.size -= self.templates.pop(victim)[1]
+            self.last_used.pop(victim, None)
+
+"""
+Returns the templates to select from: every file in template_dir, or template_dir itself
+if it is a single template.
+"""
+def list_templates(template_dir):
+    template_set = []
+    if os.path.isdir(template_dir):
+        # Sorted so that a seed selects the same templates on every file system
+        ls = sorted(os.listdir(template_dir))
+        for filename in ls:
+            # ignore hidden files
+            if filename[0] != '.':
+                template_set.append(os.path.normpath(template_dir + '/' + filename))
+    else:
+        template_set.append(template_dir)
+    return template_set
+
+"""
+The HostScheduler class multiplexes simulated hosts over a fixed pool of executor threads.
+Hosts wait in a run queue; an executor takes a host, generates up to QUANTUM of its events
+and puts it back at the end of the queue, so tens of thousands of hosts need no more
+threads than a handful.
+"""
+class HostScheduler:
+    QUANTUM = 100 # events generated for a host before the next host gets its turn
+
+    """
+    output_factory is called once per executor and returns the call that takes each
+    slice of generated events.
+    """
+    def __init__(self, hosts, executors, output_factory, callback=None, metrics=None):
+        self.hosts = hosts
+        self.run_queue = Queue()
+        self.remaining = len(hosts)
+        self.lock = Lock()
+        self.callback = callback
+        self.metrics = metrics
+        self.executors = []
+        for i in range(max(1, min(executors, len(hosts)))):
+            t = Thread(target=self.execute, args=('executor-{0}'.format(i), output_factory()))
+            t.daemon = True
+            self.executors.append(t)
+
+    def start(self):
+        print "Starting {0} executors for {1} hosts.".format(len(self.executors), len(self.hosts))
+        for host in self.hosts:
+            self.run_queue.put(host)
+        if not self.hosts:
+            self.finish(None)
+        for t in self.executors:
+            t.start()
+
+    def execute(self, name, output_call):
+        events = []
+        while True:
+            host = self.run_queue.get()
+            if host is None:
+                return
+            state, count = host.run_slice(self.QUANTUM, events, self.resume)
+            if self.metrics and count:
+                self.metrics.record_generated(name, count)
+            if events:
+                output_call(events)
+                events = []
+            if state == SimulatedHost.RUNNING:
+                self.run_queue.put(host)
+            elif state == SimulatedHost.FINISHED:
+                self.finish(host)
+            # Parked hosts are resumed by the replay scheduler
+
+    def resume(self, host):
+        self.run_queue.put(host)
+
+    def finish(self, host):
+        with self.lock:
+            self.remaining -= 1
+            done = self.remaining <= 0
+        if done:
+            # Release the executors
+            for t in self.executors:
+                self.run_queue.put(None)
+            if self.callback:
+                self.callback(self)
+
+    """
+    Returns True while any host has not finished.
+    """
+    def is_alive(self):
+        return self.remaining > 0
+
+    """
+    Send a signal for every host to stop.
+    """
+    def close(self):
+        for host in self.hosts:
+            host.close()
+
+"""
+The SimulatedHost class holds the state of one simulated machine: its template cursor,
+host/SID/user identity and iteration count. It generates events in slices when an
+executor gives it a turn.
+Each iteration draws its template and generated values from its own random stream derived
+from (seed, host, iteration), so a host's events do not depend on how hosts are spread over
+threads and processes. With a start_time, event times follow a per-host virtual clock
+instead of the wall clock.
+"""
+class SimulatedHost:
+    RUNNING = 0
+    PARKED = 1
+    FINISHED = 2
+    DEFAULT_START_TIME = 1420070400 # 2015-01-01 00:00:00 UTC, used by seeded runs
+
+    def __init__(self, id, template_set, template_cache, iterations, debug, replay=None, key_files=False,
+            seed=None, start_time=None):
         self.id = str(id)
+        self.seed = seed
+        self.clock = start_time
         self.stop = False
-        self.file_lock = file_lock
-        self.template_set = []
-        if os.path.isdir(template_dir):
-            ls = os.listdir(template_dir)
-            for filename in ls:
-                # ignore hidden files
-                if filename[0] != '.':
-                    self.template_set.append(os.path.normpath(template_dir + '/' + filename))
-        else:
-            self.template_set.append(template_dir)
+        self.template_set = template_set
+        self.template_cache = template_cache
         self.max_iterations = iterations
         self.current_iteration = 0
-        self.output_call = output_call
         self.debug = debug
-        if debug:
+        self.key_files = key_files
+        self.replay = replay
+        self.template = None
+        self.randomizer = None
+        self.pending = None # event waiting for the replay scheduler
+        self.template_start = None # wall clock time at which the current template is replayed
+        self.template_end = 0
+        self.first_event_time = None # template time of the current template's first event
+
+    """
+    Generate up to limit events, appending them to events or handing them to the replay
+    scheduler. Returns the number of events generated and RUNNING if the host has more to
+    do, PARKED if the replay scheduler will resume it through resume(host), or FINISHED.
+    """
+    def run_slice(self, limit, events, resume):
+        if self.randomizer is None and not self.begin():
+            return self.finish(), 0
+        if self.pending is not None:
+            data, release = self.pending
+            if not self.replay.schedule(data, release, lambda: resume(self)):
+                return self.PARKED, 0
+            self.pending = None
+        count = 0
+        while not self.stop:
+            try:
+                data = self.randomizer.next_event(bare=True)
+            except AllocationError as e:
+                print 'Template {0} needs more values than available: {1}\nStopping host #{2}'.format(
+                    self.template, e, self.id)
+                break
+            if data is None:
+                if not self.next_template():
+                    break
+                continue
+            if self.debug:
+                self.debug_file.write(str(data) + '\n')
+                self.template_debug_file.write(str(data) + '\n')
+            if self.replay:
+                release = self.release_time()
+                # Pending until scheduled, as the host can be resumed before schedule() returns
+                self.pending = (data, release)
+                if not self.replay.schedule(data, release, lambda: resume(self)):
+                    return self.PARKED, count
+                self.pending = None
+            else:
+                events.append(data)
+            count += 1
+            if count >= limit:
+                return self.RUNNING, count
+        return self.finish(), count
+
+    """
+    Start the first template. Returns False if the host cannot run.
+    """
+    def begin(self):
+        if self.debug:
             self.debug_file = open('debug_worker' + self.id + '-events.txt', 'w')
-        self.value_filename = 'host' + self.id + '_values.txt'
-        self.callback = callback
+        rng = self.iteration_rng()
+        self.template = self.select_template(rng)
+        self.randomizer = self.open_template(rng)
+        if not (self.randomizer and self.randomizer.generate_test(self.anchor_template())):
+            print 'Invalid template file: {0}\nStopping host #{1}'.format(self.template, self.id)
+            self.stop = True
+            return False
+        self.start_template()
+        return True
 
-    def run(self):
-        print "Starting worker #{0}.".format(self.id)
-        self.template = self.select_template()
-        self.randomizer = templateRandomizer(self.open_template())
-        if not self.randomizer.generate_test():
-            print 'Invalid template file: {0}\nStopping worker #{1}'.format(self.template, self.id)
+    def start_template(self):
+        print "Host #{0} synthesizing events from [{1}]".format(self.id, self.template)
+        if self.debug:
+            self.template_debug_file = open(
+                'debug_worker' + self.id + '-template' + str(self.current_iteration) + '.txt', 'w')
+        self.first_event_time = None
+
+    """
+    Finish the current template and start the next one, reusing host and user info.
+    Returns False once the host has run through all of its templates.
+    """
+    def next_template(self):
+        if self.debug:
+            self.template_debug_file.close()
+
+        self.current_iteration += 1
+        if self.stop or not self.need_more_templates():
+            return False
+
+        # Select and start next template
+        previous = self.randomizer
+        if self.clock is not None:
+            # Start the next template after this one ends
+            self.clock = previous.last_time + 1
+        rng = self.iteration_rng()
+        self.template = self.select_template(rng)
+        self.randomizer = self.open_template(rng)
+        # This time reuse host and user info from previous templates
+        if not (self.randomizer and
+                self.randomizer.generate_test_reuse_identity(previous.identity(), self.anchor_template())):
+            print 'Invalid template file: {0}\nStopping host #{1}'.format(self.template, self.id)
             self.stop = True
-        while self.need_more_templates() and not self.stop:
-            print "Worker #{0} synthesizing events from [{1}]".format(self.id, self.template)
-            if self.debug:
-                self.template_debug_file = open(
-                    'debug_worker' + self.id + '-template' + str(self.current_iteration) + '.txt', 'w')
-            line = self.randomizer.next_event()
-            while line != None and not self.stop:
-                # remove the list brackets and trailing newline character
-                data = line[1:-2]
-                if self.debug:
-                    self.debug_file.write(str(data) + '\n')
-                    self.template_debug_file.write(str(data) + '\n')
-                self.output_call(data)
-                line = self.randomizer.next_event()
-
-            value_file = open(self.value_filename, 'w')
-            self.randomizer.write_test_values(value_file)
-            value_file.close()
+            # Keep the last good values for the key file
+            self.randomizer = previous
+            return False
+        self.start_template()
+        return True
 
-            if self.debug:
-                self.template_debug_file.close()
-
-            # Select and start next template
-            self.template = self.select_template()
-            self.randomizer = templateRandomizer(self.open_template())
-            # This time reuse host and user info from previous templates
-            value_file = open(self.value_filename, 'r')
-            if not self.randomizer.generate_test_reuse_host(value_file):
-                print 'Invalid template file: {0}\nStopping worker #{1}'.format(self.template, self.id)
-                self.stop = True
-            value_file.close()
-            self.current_iteration += 1
+    """
+    Fix the wall clock time at which the current template is replayed: when the previous
+    template ends, or now if generation has fallen behind. Returns the time of the
+    template's last event such that it starts at the virtual clock or, when replayed, at
+    its release, or None to end it at the wall clock time.
+    """
+    def anchor_template(self):
+        if self.replay:
+            self.template_start = max(time(), self.template_end)
+        if self.clock is not None:
+            start = self.clock
+        elif self.replay:
+            start = int(self.template_start)
+        else:
+            return None
+        units = compiledTemplate.TIME_UNITS
+        return start + (self.randomizer.load_template().time_offset + units - 1) // units
 
+    def finish(self):
         if self.debug:
             self.debug_file.close()
-        if self.callback:
-            self.callback(self)
-        print "Worker #{0} has stopped.".format(self.id)
+        if self.key_files and self.randomizer:
+            self.write_key_file()
+        print "Host #{0} has stopped.".format(self.id)
+        return self.FINISHED
+
+    """
+    Write the host's last generated values to host<id>_values.txt.
+    """
+    def write_key_file(self):
+        value_file = open('host' + self.id + '_values.txt', 'w')
+        self.randomizer.write_test_values(value_file)
+        value_file.close()
 
     """
-    Send a signal for the worker to stop.
+    Returns the wall clock time at which the current event should be replayed.
+    """
+    def release_time(self):
+        if self.first_event_time is None:
+            self.first_event_time = self.randomizer.event_time
+        release = self.replay.release_time(self.template_start,
+            self.randomizer.event_time - self.first_event_time)
+        self.template_end = release
+        return release
+
+    """
+    Send a signal for the host to stop.
     """
     def close(self):
         self.stop = True
 
+    """
+    Returns the random stream of the current iteration, or the shared random module if the
+    host has no seed.
+    """
+    def iteration_rng(self):
+        if self.seed is None:
+            return random
+        return random.Random((self.seed << 64) | (int(self.id) << 32) | self.current_iteration)
+
     """
     If template_set is a directory, select a template to use at random;
     otherwise use the specified file as the template.
     """
-    def select_template(self):
-        select = random.randint(0, len(self.template_set) -1)
+    def select_template(self, rng=random):
+        select = rng.randint(0, len(self.template_set) -1)
         return self.template_set[select]
 
     """
-    Acquire a lock given by the engine to prevent simultaneous file I/O.
-    Returns a handle to the template.
+    Fetch the compiled template from the engine-wide cache.
+    Returns a randomizer for the template, or None if the template could not be loaded.
     """
-    def open_template(self):
-        self.file_lock.acquire()
-        file = open(self.template, 'r')
-        self.file_lock.release()
-        return file
+    def open_template(self, rng=random):
+        try:
+            return templateRandomizer(self.template_cache.get(self.template), rng)
+        except (IOError, ValueError):
+            return None
 
     """
     Check if we're done with opening templates.
@@ -217,27 +908,49 @@ The NetworkingWorker class batches events and sends them to the specified server
 HTTP POST.
 """
 class NetworkingWorker(Thread):
-    def __init__(self, url, output_file, rate_limit=0, debug=False):
+    MAX_PACING_INTERVAL = 0.1 # seconds of the rate limit that a default-sized batch may cover
+
+    """
+    url is a URL or a list of them, with batches spread over them by balance, one of
+    EndpointBalancer.STRATEGIES, and connections persistent connections to each;
+    rate_limit is either a number of events per second or a schedule from RateControl;
+    batch_size 0 picks a size that suits the rate limit; output_format is 'json' or 'parquet';
+    chunked sends requests with chunked transfer encoding; events beyond queue_memory megabytes
+    wait on disk under spill_dir if given, otherwise the hosts wait.
+    """
+    def __init__(self, url, output_file, rate_limit=0, debug=False, connections=4, timeout=10,
+            batch_size=0, metrics=None, output_format='json', chunked=False, queue_memory=256,
+            spill_dir=None, balance='round-robin'):
         Thread.__init__(self)
 
         self.stop = False
-        self.url = url
-        self.send_queue = Queue(300000) # maxsize = 300k events; total mem usage approx 700MB
-        self.batch_lock = Lock()
+        self.urls = [url] if isinstance(url, basestring) else list(url)
+        self.send_queue = EventQueue(queue_memory * 1024 * 1024, spill_dir)
+        self.metrics = metrics or PlaybackMetrics()
+        self.metrics.queue_depth = lambda: len(self.send_queue)
 
         self.batch_limit = 1000 # 1k strikes a balance between throughput and creating connections
         self.wait_limit = 1 # second
-        self.retry_send = False
+        self.batch_wait = self.wait_limit # longest time a partial batch waits to fill up
+        self.sender = EndpointBalancer([HTTPSender(endpoint, connections, timeout, self.wait_limit,
+            self.metrics, chunked) for endpoint in self.urls], balance)
+        self.metrics.endpoint_health = self.sender.health
 
-        self.rate_limited = False
+        self.fixed_batch_size = bool(batch_size)
+        if batch_size:
+            self.batch_limit = batch_size
+        self.rate_limiter = None
         if rate_limit:
-            self.batch_limit = rate_limit
-            self.rate_limited = True
-        self.send_timer = Timer(self.wait_limit, self.send_batch)
-        self.batch = []
+            if isinstance(rate_limit, (int, long, float)):
+                rate_limit = ConstantRate(rate_limit)
+            # Allow one batch of burst on top of the scheduled rate
+            self.rate_limiter = TokenBucket(rate_limit, self.batch_limit)
         self.debug = debug
-        if output_file:
-            self.output_file = open(output_file, 'w')
+        if output_file and output_format == 'parquet':
+            self.output_file = ParquetEventWriter(output_file)
+        elif output_file:
+            # A .gz or .zst file is compressed on background threads
+            self.output_file = open_output(output_file)
         elif debug:
             self.output_file = open('debug_network_batch.txt', 'w')
         else:
@@ -245,88 +958,555 @@ class NetworkingWorker(Thread):
 
     def run(self):
         print "Starting networking worker."
-        # Start the timers
-        self.send_timer.start()
+        if len(self.urls) > 1:
+            print 'Spreading batches over {0} endpoints ({1}).'.format(len(self.urls), self.sender.strategy)
+        self.sender.start()
 
         while not self.stop:
-            while len(self.batch) < self.batch_limit:
-                self.batch_lock.acquire()
-                if not self.send_queue.empty():
-                    self.batch.append(self.send_queue.get())
-                    self.batch_lock.release()
-                else:
-                    self.batch_lock.release()
-                    break
-
-                # If the batch has reached our limit and we are not rate limiting,
-                # send it away
-                # Otherwise, the timer will take care of sending
-                if len(self.batch) >= self.batch_limit and not self.rate_limited and not self.retry_send:
-                    self.send_batch()
-            sleep(0.05)
-        # Empty out the queue so that any blocking workers may finish
-        while not self.send_queue.empty():
-            self.send_queue.get(True, 1)
-        self.batch = []
+            # Wait until a full batch is queued or batch_wait has passed since its first event
+            batch = self.send_queue.get_batch(self.next_batch_size(), self.batch_wait)
+            if self.rate_limiter and batch:
+                self.rate_limiter.acquire(len(batch))
+            self.send_batch(batch)
+            self.send_queue.task_done(len(batch))
+        # Release any blocking workers so that they may finish
+        self.send_queue.close()
         if self.output_file:
             self.output_file.close()
 
         print 'Networker has stopped.'
 
+    """
+    Without an explicit batch size, rate limited batches cover at most
+    MAX_PACING_INTERVAL seconds of the current rate so that sends are spread out.
+    """
+    def next_batch_size(self):
+        if self.fixed_batch_size or not self.rate_limiter:
+            return self.batch_limit
+        pacing_size = int(self.rate_limiter.current_rate() * self.MAX_PACING_INTERVAL)
+        return min(self.batch_limit, max(1, pacing_size))
+
     def add_event_to_batch(self, event):
         # Put an event into the queue -- will block if the queue is full
         self.send_queue.put(event)
 
+    def add_events_to_batch(self, events):
+        # Put a list of events into the queue -- will block if the queue is full
+        self.send_queue.put_many(events)
+
     """
-    Send the batch away when it is either full or enough time has passed
+    Send a batch away once it is either full or enough time has passed
     """
-    def send_batch(self):
-        # Cancel the timer
-        self.send_timer.cancel()
-
-        self.batch_lock.acquire()
-        self.retry_send = False
-        if len(self.batch) > 0 and not self.stop:
-            # format the batch to match JSON specs
-            post = '[' + ','.join(self.batch) + ']\r\n'
-            request = urllib2.Request(self.url, post)
-            # Send the events and receive response
-            # Fire and forget
-            try:
-                response = urllib2.urlopen(request, timeout=0.05)
-            except urllib2.URLError as e:
-                print 'Could not connect to {0}\nRetrying in {1} seconds...'.format(self.url, self.wait_limit)
-                self.retry_send = True
-            except:
-                # Some targets might not respond at all
-                pass
+    def send_batch(self, batch):
+        if len(batch) > 0 and not self.stop:
+            self.metrics.record_batch(len(batch))
+            # Hand the batch to a free connection; blocks while all connections are busy.
+            # The sender formats it as a JSON list while sending.
+            self.sender.submit(batch)
             if self.output_file:
-                self.output_file.write(post + '\n')
-
-            # If the send was successful, clear the batch
-            if not self.retry_send:
-                self.batch = []
-        self.batch_lock.release()
-        # Restart the timer
-        if not self.stop:
-            self.send_timer = Timer(self.wait_limit, self.send_batch)
-            self.send_timer.start()
+                self.output_file.write('[' + ','.join(batch) + ']\r\n\n')
 
     """
     Ask the worker nicely to off itself.
     """
     def close(self):
-        # Cancel the timer
-        self.send_timer.cancel()
+        self.sender.close()
         self.stop = True
+        # Wake the worker if it is waiting on an empty queue
+        self.send_queue.close()
+
+    """
+    Send partial batches as soon as they are taken rather than waiting for them to fill.
+    """
+    def drain(self):
+        self.send_queue.drain()
 
     """
-    Wait for everything in the queue to be sent before closing the worker.
+    Wait for everything in the queue to be sent, then close the worker and wait for it to stop.
     """
     def finish_then_close(self):
-        while not (self.send_queue.empty() and len(self.batch) == 0):
-            sleep(1)
+        self.drain()
+        while self.send_queue.unfinished or self.sender.busy():
+            sleep(0.1)
         self.close()
+        if self.is_alive():
+            self.join()
+
+"""
+The EventQueue class is a FIFO of events, bounded by the memory they take, that hands them
+out in batches. get_batch blocks until a full batch is queued or a deadline passes, then
+takes the whole batch under a single lock acquisition.
+Producers block while max_bytes are queued, unless a spill_dir is given: then the overflow
+is appended to segment files in a fresh directory under spill_dir and read back in order
+once the events in memory have been handed out.
+"""
+class EventQueue:
+    EVENT_OVERHEAD = 48 # bytes held per queued event besides its characters
+    SEGMENT_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, max_bytes=0, spill_dir=None):
+        self.max_bytes = max_bytes # 0 means unbounded
+        self.events = deque()
+        self.bytes = 0 # memory taken by the events in self.events, measured as they are added
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+        self.wanted = 1 # number of queued events that wakes the consumer
+        self.unfinished = 0 # events queued or handed out but not yet marked done
+        self.closed = False
+        self.draining = False # no more events are coming, so partial batches do not wait
+        self.spill_dir = None
+        if spill_dir and max_bytes:
+            self.spill_dir = tempfile.mkdtemp(prefix='spill-', dir=spill_dir)
+        self.segment_bytes = min(self.SEGMENT_BYTES, max_bytes)
+        self.segments = deque() # [path, events, bytes] of each spilled segment, oldest first
+        self.segment_file = None # open file of the newest segment
+        self.spilled = 0 # events waiting in segment files
+        self.segment_count = 0
+
+    """
+    Returns the number of events queued in memory and on disk.
+    """
+    def __len__(self):
+        return len(self.events) + self.spilled
+
+    def full(self):
+        return self.max_bytes and self.bytes >= self.max_bytes
+
+    """
+    Add an event, blocking while the queue is full. Events are dropped once closed.
+    """
+    def put(self, event):
+        with self.lock:
+            # full() is spelled out on this per-event path
+            max_bytes = self.max_bytes
+            while not self.spill_dir and max_bytes and self.bytes >= max_bytes and not self.closed:
+                self.not_full.wait()
+            if self.closed:
+                return
+            if self.spilled or (max_bytes and self.bytes >= max_bytes):
+                self.spill((event,))
+            else:
+                self.events.append(event)
+                self.bytes += len(event) + self.EVENT_OVERHEAD
+            self.unfinished += 1
+            if len(self.events) + self.spilled >= self.wanted:
+                self.not_empty.notify()
+
+    """
+    Add a list of events at once, blocking while the queue is full.
+    """
+    def put_many(self, events):
+        with self.lock:
+            while not self.spill_dir and self.full() and not self.closed:
+                self.not_full.wait()
+            if self.closed:
+                return
+            # Once anything is on disk, later events follow it there to keep the order
+            if self.spilled or self.full():
+                self.spill(events)
+            else:
+                self.events.extend(events)
+                self.bytes += sum(itertools.imap(len, events)) + self.EVENT_OVERHEAD * len(events)
+            self.unfinished += len(events)
+            if len(self) >= self.wanted:
+                self.not_empty.notify()
+
+    """
+    Append events to the newest segment file, starting a new one every segment_bytes.
+    """
+    def spill(self, events):
+        if self.segment_file is None or self.segments[-1][2] >= self.segment_bytes:
+            if self.segment_file:
+                self.segment_file.close()
+            self.segment_count += 1
+            path = os.path.join(self.spill_dir, 'segment-{0:08d}'.format(self.segment_count))
+            self.segment_file = open(path, 'wb')
+            self.segments.append([path, 0, 0])
+        # Events never contain a newline, so a segment is one event per line
+        data = '\n'.join(events) + '\n'
+        self.segment_file.write(data)
+        segment = self.segments[-1]
+        segment[1] += len(events)
+        segment[2] += len(data)
+        self.spilled += len(events)
+
+    """
+    Move the oldest spilled segment back into memory and delete its file.
+    """
+    def load_segment(self):
+        path, count, size = self.segments.popleft()
+        if not self.segments and self.segment_file:
+            self.segment_file.close()
+            self.segment_file = None
+        with open(path, 'rb') as segment_file:
+            events = segment_file.read().split('\n')
+        os.remove(path)
+        events.pop() # empty string after the last newline
+        self.events.extend(events)
+        # size counts a newline per event
+        self.bytes += size + (self.EVENT_OVERHEAD - 1) * count
+        self.spilled -= count
+
+    """
+    Returns up to max_items events. Blocks until the first event arrives, then until
+    max_items are queued or timeout seconds have passed. Returns an empty list once closed.
+    """
+    def get_batch(self, max_items, timeout):
+        with self.lock:
+            # Untimed waits block without polling
+            while not len(self) and not self.closed:
+                self.not_empty.wait()
+            deadline = time() + timeout
+            self.wanted = max_items
+            # A backlog on disk means there is no point waiting for more events
+            while len(self.events) < max_items and not self.spilled and not (self.closed or self.draining):
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+            self.wanted = 1
+            if not self.events and self.spilled and not self.closed:
+                self.load_segment()
+            queued = len(self.events)
+            count = min(max_items, queued)
+            popleft = self.events.popleft
+            batch = [popleft() for i in xrange(count)]
+            if count:
+                # Charge the batch at the mean size of the queued events rather than measuring it
+                self.bytes = self.bytes * (queued - count) // queued
+                self.not_full.notify_all()
+        return batch
+
+    """
+    Mark count events handed out by get_batch as processed.
+    """
+    def task_done(self, count):
+        with self.lock:
+            if not self.closed:
+                self.unfinished -= count
+
+    """
+    Hand out partial batches from now on instead of waiting for them to fill.
+    """
+    def drain(self):
+        with self.lock:
+            self.draining = True
+            self.not_empty.notify_all()
+
+    """
+    Wake every waiting producer and consumer; queued and further events are dropped
+    and the spill directory is removed.
+    """
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.events.clear()
+            self.bytes = 0
+            self.unfinished = 0
+            if self.segment_file:
+                self.segment_file.close()
+                self.segment_file = None
+            if self.spill_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.segments.clear()
+            self.spilled = 0
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+"""
+The EndpointBalancer class spreads batches over the HTTPSenders of several endpoints,
+each with its own connection pool. Strategies are 'round-robin', 'least-outstanding'
+(the endpoint with the fewest batches in flight) and 'host', which splits each batch by
+the host field of its events so that a simulated host always goes to the same endpoint.
+Endpoints that failed recently are passed over, and a sender that cannot reach its
+endpoint hands the batch to a healthy one.
+"""
+class EndpointBalancer:
+    STRATEGIES = ['round-robin', 'least-outstanding', 'host']
+    HOST_FIELD = '"host":"'
+    MAX_HOSTS = 100000 # host names whose endpoint is remembered
+
+    def __init__(self, senders, strategy='round-robin'):
+        self.senders = senders
+        self.strategy = strategy
+        self.turn = itertools.count()
+        self.host_indexes = {} # host name -> index of its endpoint
+        for sender in senders:
+            sender.reroute = self.reroute
+
+    def start(self):
+        for sender in self.senders:
+            sender.start()
+
+    def submit(self, batch):
+        if self.strategy == 'host' and len(self.senders) > 1:
+            for index, events in self.split_by_host(batch).iteritems():
+                self.sender_for(index).submit(events)
+        else:
+            (self.pick() or self.senders[next(self.turn) % len(self.senders)]).submit(batch)
+
+    """
+    Returns the next healthy sender other than exclude, or None if there is none.
+    """
+    def pick(self, exclude=None):
+        candidates = [sender for sender in self.senders if sender is not exclude and sender.healthy()]
+        if not candidates:
+            return None
+        if self.strategy == 'least-outstanding':
+            return min(candidates, key=lambda sender: sender.outstanding())
+        return candidates[next(self.turn) % len(candidates)]
+
+    """
+    Returns the sender at index, or the next healthy one after it while it is down.
+    """
+    def sender_for(self, index):
+        count = len(self.senders)
+        for i in xrange(count):
+            sender = self.senders[(index + i) % count]
+            if sender.healthy():
+                return sender
+        return self.senders[index]
+
+    """
+    Returns the events of batch grouped by the endpoint index of their host field.
+    """
+    def split_by_host(self, batch):
+        parts = {}
+        field = self.HOST_FIELD
+        skip = len(field)
+        count = len(self.senders)
+        indexes = self.host_indexes
+        if len(indexes) > self.MAX_HOSTS:
+            indexes.clear()
+        for event in batch:
+            start = event.find(field) + skip
+            host = event[start:event.find('"', start)] if start >= skip else ''
+            index = indexes.get(host)
+            if index is None:
+                # crc32 rather than hash() so that hosts map the same way in every run
+                index = indexes[host] = (zlib.crc32(host) & 0xffffffff) % count
+            if index in parts:
+                parts[index].append(event)
+            else:
+                parts[index] = [event]
+        return parts
+
+    """
+    Submit a batch that sender could not deliver to a healthy endpoint.
+    Returns False if there is none, leaving sender to retry it.
+    """
+    def reroute(self, sender, batch):
+        target = self.pick(exclude=sender)
+        if target is None:
+            return False
+        target.submit(batch)
+        return True
+
+    """
+    Returns True while any submitted batch has not been sent.
+    """
+    def busy(self):
+        return any(sender.busy() for sender in self.senders)
+
+    """
+    Returns whether each endpoint is currently considered healthy, by URL.
+    """
+    def health(self):
+        return dict((sender.url, sender.healthy()) for sender in self.senders)
+
+    def close(self):
+        for sender in self.senders:
+            sender.close()
+
+"""
+The HTTPSender class posts batches to the target over a pool of persistent HTTP/1.1
+connections. Each connection is owned by its own sender thread, so up to in_flight
+requests are outstanding at once and each connection is reused across batches.
+A batch is streamed as it is serialized, PIECE_EVENTS events at a time, so the whole
+request body is never held in memory; with chunked set it is sent with chunked
+transfer encoding instead of a Content-Length.
+"""
+class HTTPSender:
+    PIECE_EVENTS = 64
+    HEALTH_BACKOFF = 5 # seconds an endpoint is passed over after a failed request
+
+    def __init__(self, url, in_flight=4, timeout=10, retry_wait=1, metrics=None, chunked=False):
+        self.url = url
+        self.metrics = metrics or PlaybackMetrics()
+        parsed = urlparse.urlsplit(url)
+        self.secure = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        # The same header lines as the urllib2 requests of earlier versions, so that raw
+        # captures keep one request line, six headers and a blank line before each body
+        self.headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive',
+            'User-Agent': 'Python-urllib/' + sys.version[:3]}
+        self.chunked = chunked
+        self.timeout = timeout
+        self.retry_wait = retry_wait
+        self.stop = False
+        self.down_until = 0
+        self.reroute = None # called with (sender, batch) to hand a failed batch elsewhere
+        self.pending = Queue(in_flight)
+        self.threads = []
+        for i in range(in_flight):
+            t = Thread(target=self.send_loop)
+            t.daemon = True
+            self.threads.append(t)
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    """
+    Queue a batch of events for the next free connection; the batch must not change
+    afterwards. Blocks while every connection has a request in flight.
+    """
+    def submit(self, batch):
+        self.pending.put(batch)
+
+    """
+    Returns True while any submitted batch has not been sent.
+    """
+    def busy(self):
+        return self.pending.unfinished_tasks > 0
+
+    """
+    Returns the number of batches submitted but not yet sent.
+    """
+    def outstanding(self):
+        return self.pending.unfinished_tasks
+
+    """
+    Returns False for HEALTH_BACKOFF seconds after a request failed, then True again so
+    that the endpoint gets another try.
+    """
+    def healthy(self):
+        return time() >= self.down_until
+
+    def mark_down(self):
+        self.down_until = time() + self.HEALTH_BACKOFF
+
+    def close(self):
+        self.stop = True
+
+    def connect(self):
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    """
+    Returns the size of the JSON list that body_pieces makes of batch.
+    """
+    @staticmethod
+    def body_size(batch):
+        # '[' + events separated by ',' + ']\r\n'
+        return sum(itertools.imap(len, batch)) + len(batch) + 3
+
+    """
+    Yield the request body for a non-empty batch in pieces of up to PIECE_EVENTS events.
+    Only the first and last event of each piece are copied to add the brackets,
+    separators and chunk framing; the rest are joined straight into the piece.
+    """
+    def body_pieces(self, batch):
+        last = len(batch)
+        step = self.PIECE_EVENTS
+        for start in xrange(0, last, step):
+            events = batch[start:start + step]
+            events[0] = ('[' if start == 0 else ',') + events[0]
+            if start + step >= last:
+                events[-1] += ']\r\n'
+            if self.chunked:
+                size = sum(itertools.imap(len, events)) + len(events) - 1
+                events[0] = '{0:x}\r\n'.format(size) + events[0]
+                # The zero-length chunk ends the body
+                events[-1] += '\r\n0\r\n\r\n' if start + step >= last else '\r\n'
+            yield ','.join(events)
+
+    """
+    Send batch as a POST on connection, streaming the body piece by piece.
+    """
+    def post(self, connection, batch, size):
+        if connection.sock is None:
+            connection.connect()
+            # Pieces are sent as soon as they are ready rather than waiting on delayed ACKs
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.putrequest('POST', self.path)
+        for name, value in self.headers.iteritems():
+            connection.putheader(name, value)
+        if self.chunked:
+            connection.putheader('Transfer-Encoding', 'chunked')
+        else:
+            connection.putheader('Content-Length', str(size))
+        pieces = self.body_pieces(batch)
+        # The headers go out in the same send as the first piece
+        connection.endheaders(next(pieces))
+        for piece in pieces:
+            connection.send(piece)
+
+    def send_loop(self):
+        connection = None
+        while True:
+            batch = self.pending.get()
+            size = self.body_size(batch)
+            while not self.stop:
+                reused = connection is not None
+                if connection is None:
+                    connection = self.connect()
+                started = time()
+                sent = False
+                try:
+                    self.post(connection, batch, size)
+                    sent = True
+                    response = connection.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    connection.close()
+                    connection = None
+                    if sent and isinstance(e, socket.timeout):
+                        # Some targets might not respond at all; the request went out, so do not resend it
+                        print 'No response from {0} within {1} seconds.'.format(self.url, self.timeout)
+                        self.metrics.record_timeout()
+                        self.mark_down()
+                        break
+                    # A timeout while connecting or sending is retried like any other failure.
+                    # The server may have dropped an idle connection; retry once on a new one
+                    if reused:
+                        continue
+                    self.mark_down()
+                    if self.reroute and self.reroute(self, batch):
+                        print 'Could not connect to {0}\nSent the batch to another endpoint.'.format(self.url)
+                        self.metrics.record_retry()
+                        break
+                    print 'Could not connect to {0}\nRetrying in {1} seconds...'.format(self.url, self.retry_wait)
+                    self.metrics.record_retry()
+                    sleep(self.retry_wait)
+                    continue
+                if response.version == 9:
+                    # Not an HTTP response (e.g. the sample listener); nothing to read or reuse
+                    self.metrics.record_request(size, time() - started, self.url)
+                    self.down_until = 0
+                    connection.close()
+                    connection = None
+                    break
+                try:
+                    # Read the whole response so that the connection can be reused
+                    response.read()
+                except (httplib.HTTPException, socket.error):
+                    response.will_close = True
+                self.metrics.record_request(size, time() - started, self.url)
+                self.down_until = 0
+                if response.status >= 400:
+                    print 'Server at {0} responded with {1} {2}'.format(self.url, response.status, response.reason)
+                    self.metrics.record_error()
+                if response.will_close:
+                    connection.close()
+                    connection = None
+                break
+            self.pending.task_done()
 
 if __name__ == "__main__":
     parser = ArgumentParser(
@@ -335,43 +1515,195 @@ if __name__ == "__main__":
         'templates',
         help='The event template or directory of templates to generate synthetic events from.'
     )
+    parser.add_argument(
+        '-b', '--batch-size',
+        type=int,
+        metavar='NUM',
+        default=0,
+        help='Send up to NUM events per request. Defaults to 1000, or a tenth of a second ' +
+            'of events when the rate is limited.')
+    parser.add_argument(
+        '--balance',
+        choices=EndpointBalancer.STRATEGIES,
+        default='round-robin',
+        help='How batches are spread over several URLs: in turn, to the endpoint with the ' +
+            'fewest batches in flight, or split by simulated host so that each host always ' +
+            'goes to the same endpoint. Endpoints that fail are skipped for a few seconds.')
+    parser.add_argument(
+        '-c', '--cache-size',
+        type=int,
+        metavar='MB',
+        default=1024,
+        help='Keep up to MB megabytes of compiled templates in memory, evicting the least ' +
+            'recently used. Specifying 0 will keep every template.')
+    parser.add_argument(
+        '--chunked',
+        action='store_true',
+        help='Send requests with chunked transfer encoding rather than a Content-Length. ' +
+            'The server must accept HTTP/1.1 chunked requests.')
+    parser.add_argument(
+        '--connections',
+        type=int,
+        metavar='NUM',
+        default=4,
+        help='Keep NUM persistent connections to URL, allowing NUM requests in flight.')
     parser.add_argument(
         '-d', '--debug',
         action='store_true',
         help='Enable debugging output.')
+    parser.add_argument(
+        '-f', '--output-format',
+        choices=['json', 'parquet'],
+        default='json',
+        help='Write the output FILE as JSON batches, one per line, or as a Parquet file of ' +
+            'dictionary encoded columns (requires pyarrow). Defaults to json.')
     parser.add_argument(
         '-i', '--iterations',
         type=int,
         metavar='NUM',
         default=1,
         help='Run through NUM templates. Specifying 0 will run continuously.')
+    parser.add_argument(
+        '-k', '--key-files',
+        action='store_true',
+        help='Write each machine\'s generated host, user, SID and PID values to ' +
+            'host<N>_values.txt when it stops.')
     parser.add_argument(
         '-m', '--machines',
         type=int,
         metavar='NUM',
         default=1,
-        help='The number of machine hosts to simulate -- a thread will be spawned for each machine.')
+        help='The number of machine hosts to simulate.')
     parser.add_argument(
         '-n', '--rate',
         type=int,
         metavar='NUM',
         default=0,
         help='Limit the rate of events sent over the network to NUM events per second.')
+    parser.add_argument(
+        '--rate-schedule',
+        type=parse_rate_schedule,
+        metavar='SCHEDULE',
+        help='Vary the rate limit over time: ramp:START:END:SECONDS, ' +
+            'step:RATE@SECONDS[,RATE@SECONDS...] or sine:MEAN:AMPLITUDE:PERIOD. Overrides --rate.')
     parser.add_argument(
         '-o', '--output',
         metavar='FILE',
-        help='Write the generated events out to FILE.')
+        help='Write the generated events out to FILE. JSON output is compressed if FILE ends ' +
+            'in .gz or .zst (requires zstandard).')
+    parser.add_argument(
+        '-p', '--processes',
+        type=int,
+        metavar='NUM',
+        help='Spread the simulated machines across NUM generator processes. Defaults to 1, ' +
+            'or to the number of CPUs when generating to files without a URL.')
+    parser.add_argument(
+        '--queue-memory',
+        type=int,
+        metavar='MB',
+        default=256,
+        help='Queue up to MB megabytes of events waiting to be sent. When the queue is full ' +
+            'the hosts wait, or the events spill to disk with --spill-dir.')
+    parser.add_argument(
+        '--start-time',
+        type=int,
+        metavar='SECONDS',
+        help='Timestamp events from a virtual clock per machine starting at SECONDS since the ' +
+            'epoch. Seeded runs start at {0} unless given; others use the current time.'.format(
+                SimulatedHost.DEFAULT_START_TIME))
+    parser.add_argument(
+        '--stats-file',
+        metavar='FILE',
+        help='Append a JSON snapshot of the playback metrics to FILE at every stats interval ' +
+            'and when playback ends.')
+    parser.add_argument(
+        '--stats-interval',
+        type=float,
+        metavar='SECONDS',
+        default=10,
+        help='Print throughput and latency statistics every SECONDS. Specifying 0 disables them.')
+    parser.add_argument(
+        '--stats-port',
+        type=int,
+        metavar='PORT',
+        help='Serve the playback metrics in the Prometheus text format on 127.0.0.1:PORT.')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        metavar='NUM',
+        help='Derive the random data of every machine and iteration from NUM, so that each ' +
+            'machine generates the same events on every run. Defaults to a random seed, ' +
+            'which is printed.')
+    parser.add_argument(
+        '--shards',
+        type=int,
+        metavar='NUM',
+        help='Split the machines into NUM output files when generating without a URL. ' +
+            'Defaults to the number of processes.')
+    parser.add_argument(
+        '-s', '--speed',
+        type=float,
+        metavar='FACTOR',
+        default=0,
+        help='Release events at their template timestamps, FACTOR times faster than they ' +
+            'were recorded (e.g. 1, 10 or 0.5). By default events are sent as fast as possible.')
+    parser.add_argument(
+        '--spill-dir',
+        metavar='DIR',
+        help='Write events that do not fit in --queue-memory to files under DIR and send them ' +
+            'in order once the target catches up, rather than pausing the hosts.')
+    parser.add_argument(
+        '-t', '--timeout',
+        type=float,
+        metavar='SECONDS',
+        default=10,
+        help='Wait up to SECONDS for the server to respond to each batch.')
     parser.add_argument(
         '-u', '--url',
         metavar='URL',
-        help='The URL to send events to.',
-        required=True)
+        action='append',
+        help='The URL to send events to. Repeat to spread the events over several endpoints ' +
+            '(see --balance). Without a URL, events are generated straight into ' +
+            'the output FILE, one file per process.')
     parser.add_argument(
         '-v', '--version',
         action='version', version='%(prog)s v1.0')
+    parser.add_argument(
+        '-x', '--executors',
+        type=int,
+        metavar='NUM',
+        default=4,
+        help='Generate events for the simulated machines on NUM threads (per process).')
     args = parser.parse_args()
+    try:
+        if args.output_format == 'parquet':
+            load_pyarrow()
+        elif args.output and compression_for(args.output):
+            chunk_compressor(compression_for(args.output))
+    except ImportError as e:
+        parser.error(str(e))
+    if not args.url:
+        if not args.output:
+            parser.error('either -u/--url or -o/--output is required')
+        if args.iterations == 0:
+            parser.error('generating to files without a URL needs a number of iterations')
     if args.debug:
         print 'Debug mode enabled.'
-    engine = PlaybackEngine(args.templates, args.machines, args.iterations, args.url,
-        args.output, args.rate, args.debug)
+    start_time = args.start_time
+    if start_time is None and args.seed is not None:
+        start_time = SimulatedHost.DEFAULT_START_TIME
+    if args.url:
+        rate = args.rate_schedule or args.rate
+        if args.rate_schedule:
+            print 'Rate schedule: {0}'.format(args.rate_schedule)
+        engine = PlaybackEngine(args.templates, args.machines, args.iterations, args.url,
+            args.output, rate, args.debug, args.cache_size, args.processes or 1, args.connections,
+            args.timeout, args.batch_size, args.speed, args.executors, args.stats_interval, args.stats_file,
+            args.stats_port, args.key_files, args.output_format, args.seed, start_time, args.chunked,
+            args.queue_memory, args.spill_dir, args.balance)
+    else:
+        # Bulk mode: generate straight into files
+        engine = BulkEngine(args.templates, args.machines, args.iterations, args.output,
+            args.output_format, args.processes or cpu_count(), args.seed, args.debug, args.cache_size,
+            args.key_files, args.shards, start_time)
     engine.start()
@@ -67,46 +67,85 @@ class replaceVariables:
 #End class
 
 #Class with methods to create random data
+#rng is a random.Random stream, or the random module itself. Values are drawn in bulk:
+#strings are made STRING_BLOCK at a time from two draws of random bytes and handed out
+#one by one, and SID domains are tried SID_CANDIDATES at a time from a single draw
 class generateRandomData:
     MIN_STRING_LENGTH = 3
     MAX_STRING_LENGTH = 15
     SID_VARIABLE = '$SID'
+    STRING_CHARACTERS = string.ascii_uppercase + '-&!#'
+    STRING_LENGTHS = ''.join(map(chr, range(MIN_STRING_LENGTH, MAX_STRING_LENGTH + 1)))
+    STRING_BLOCK = 8
+    SID_CANDIDATES = 16 #about 1 in 13 candidates is accepted
+    #A string of 29 digits is a 96-bit number when it lies between these two
+    SID_LOWER = str(2 ** 95)
+    SID_UPPER = str(2 ** 96)
+    translations = {} #alphabet -> (translation table, bytes to drop)
+
+    def __init__(self, rng=random):
+        self.rng = rng
+        self.strings = []
+
     #Method to generate random string
     def randomString(self):
-        symbol_set = '-&!#'
-        length = random.randint(self.MIN_STRING_LENGTH, self.MAX_STRING_LENGTH)
-        return ''.join(random.choice(string.ascii_uppercase + symbol_set) for x in range(length))
+        if not self.strings:
+            self.strings = self.randomStrings(self.STRING_BLOCK)
+        return self.strings.pop()
+
+    #Method to generate count random strings at once
+    def randomStrings(self, count):
+        lengths = [ord(length) for length in self.randomCharacters(count, self.STRING_LENGTHS)]
+        characters = self.randomCharacters(sum(lengths), self.STRING_CHARACTERS)
+        strings = []
+        start = 0
+        for length in lengths:
+            strings.append(characters[start:start + length])
+            start += length
+        return strings
+
+    #Method to draw count characters uniformly from alphabet out of bulk random bytes.
+    #Bytes at or above the largest multiple of len(alphabet) are dropped so none is favoured
+    def randomCharacters(self, count, alphabet):
+        table, dropped = self.translation(alphabet)
+        characters = ''
+        while len(characters) < count:
+            needed = count - len(characters)
+            characters += self.randomBytes(needed + needed // 8 + 4).translate(table, dropped)
+        return characters[:count]
+
+    def randomBytes(self, count):
+        return ('%0*x' % (count * 2, self.rng.getrandbits(count * 8))).decode('hex')
+
+    def translation(self, alphabet):
+        if alphabet not in self.translations:
+            limit = 256 - 256 % len(alphabet)
+            table = ''.join(alphabet[i % len(alphabet)] for i in range(256))
+            self.translations[alphabet] = (table, ''.join(map(chr, range(limit, 256))))
+        return self.translations[alphabet]
 
     #Method to generate random SID
     def randomSIDdomain(self):
         beginning_of_SID = "S-1-5-21"
         #create 96-bit random number w/ three subauthorities that receive 32-bit chunks
-        num1 = random.getrandbits(32)
-        num2 = random.getrandbits(32)
-        num3 =random.getrandbits(32)
-        string_96_bit = str(num1) + str(num2) + str(num3)
-        num_96_bit = int(string_96_bit)
-        while (num_96_bit.bit_length()!=96):
-            num1 = random.getrandbits(32)
-            num2 = random.getrandbits(32)
-            num3 =random.getrandbits(32)
-            string_96_bit = str(num1) + str(num2) + str(num3)
-            num_96_bit = int(string_96_bit)
-        return(beginning_of_SID + "-" + str(num1) + "-" + str(num2) + "-" + str(num3))
-
-    def randomRID(self, previous_rids):
-        RID = random.randint(1000,9999)
-        while RID in previous_rids.values():
-            RID = random.randint(1000,9999)
-        return RID
-
-    def randomPID(self, previous_pids):
-        num = random.randint(0,2499)
-        num = num*4
-        while num in previous_pids.values():
-            num = random.randint(0,2499)
-            num = num*4
-        return num
+        while True:
+            bits = self.rng.getrandbits(96 * self.SID_CANDIDATES)
+            for i in xrange(self.SID_CANDIDATES):
+                num1 = bits & 0xFFFFFFFF
+                num2 = (bits >> 32) & 0xFFFFFFFF
+                num3 = (bits >> 64) & 0xFFFFFFFF
+                bits >>= 96
+                string_96_bit = str(num1) + str(num2) + str(num3)
+                if len(string_96_bit) == 29 and self.SID_LOWER <= string_96_bit < self.SID_UPPER:
+                    return(beginning_of_SID + "-" + str(num1) + "-" + str(num2) + "-" + str(num3))
+
+    #Method to create an allocator of unique RIDs from 1000 to 9999
+    def ridAllocator(self):
+        return uniqueRandomAllocator('RID', 9000, self.rng, offset=1000)
+
+    #Method to create an allocator of unique PIDs: multiples of 4 below 10000
+    def pidAllocator(self):
+        return uniqueRandomAllocator('PID', 2500, self.rng, scale=4)
 
     def findNum(self, line, variable_name):
         variable_num = ""
@@ -130,6 +169,147 @@ class generateRandomData:
         return time
     #End class
 
+#Raised when a uniqueRandomAllocator has handed out every value
+class AllocationError(Exception):
+    pass
+
+#Class that hands out distinct random values offset + scale * i for i in range(count).
+#It is a Fisher-Yates shuffle carried out only as far as values are taken, so each
+#allocation is O(1) however many values are in use
+class uniqueRandomAllocator:
+    def __init__(self, name, count, rng=random, scale=1, offset=0):
+        self.name = name
+        self.count = count
+        self.rng = rng
+        self.scale = scale
+        self.offset = offset
+        self.taken = 0 #positions below taken hold the values in use
+        self.moved = {} #position -> index that a swap placed there
+        self.positions = {} #index -> position, for indices that have been swapped
+
+    def index_at(self, position):
+        return self.moved.get(position, position)
+
+    def position_of(self, index):
+        return self.positions.get(index, index)
+
+    def swap(self, a, b):
+        index_a = self.index_at(a)
+        index_b = self.index_at(b)
+        self.moved[a] = index_b
+        self.positions[index_b] = a
+        self.moved[b] = index_a
+        self.positions[index_a] = b
+
+    #Returns a random value that is not in use; raises AllocationError once all are taken
+    def allocate(self):
+        if self.taken >= self.count:
+            raise AllocationError('all {0} {1} values are in use'.format(self.count, self.name))
+        self.swap(self.taken, self.taken + self.rng.randrange(self.count - self.taken))
+        index = self.index_at(self.taken)
+        self.taken += 1
+        return self.offset + index * self.scale
+
+    #Mark a value loaded from elsewhere as in use
+    def reserve(self, value):
+        index, remainder = divmod(int(value) - self.offset, self.scale)
+        if remainder or not 0 <= index < self.count:
+            return
+        position = self.position_of(index)
+        if position >= self.taken:
+            self.swap(self.taken, position)
+            self.taken += 1
+
+    def __len__(self):
+        return self.taken
+#End class
+
+#Class that splits a template into literal fragments and typed variable slots.
+#Templates are scanned once here so that filling an event is a single join
+class compiledTemplate:
+    HOST_SLOT = 0
+    SID_SLOT = 1
+    USERNAME_SLOT = 2
+    LUSERNAME_SLOT = 3
+    PID_SLOT = 4
+    TIME_SLOT = 5
+    TIME_UNITS = 1000 #template times are milliseconds since the recording started
+
+    #Bytes taken by the objects that make up a compiled event, for the size estimate
+    STRING_BYTES = sys.getsizeof('')
+    TUPLE_BYTES = sys.getsizeof(())
+    POINTER_BYTES = sys.getsizeof((None,)) - sys.getsizeof(())
+    SLOT_BYTES = sys.getsizeof((0, '')) + sys.getsizeof('0')
+
+    #$SID is followed by exactly one identifier character, the others by any number of digits
+    SLOT_PATTERN = re.compile(r'\$(?:HOST(\d*)|SID(.?)|USERNAME(\d*)|LUSERNAME(\d*)|PID(\d*))|"time":(-?\d+)(?=,")')
+
+    def __init__(self, template_file):
+        #First line of the template holds the total duration; raises ValueError if malformed
+        self.time_offset = int(template_file.readline().rstrip())
+        self.events = []
+        #Approximate bytes of memory held by the compiled events
+        self.size = sys.getsizeof(self.events)
+        for line in template_file:
+            event = self.compileLine(line)
+            self.events.append(event)
+            self.size += self.eventSize(event)
+        template_file.close()
+
+    """
+    Returns the approximate bytes of memory held by a compiled event, counting its
+    literals, slots, their tuples and its entry in events.
+    """
+    def eventSize(self, event):
+        literals, slots = event
+        return (sum(map(len, literals)) + len(literals) * (self.STRING_BYTES + self.POINTER_BYTES)
+            + len(slots) * (self.SLOT_BYTES + self.POINTER_BYTES)
+            + 3 * self.TUPLE_BYTES + 3 * self.POINTER_BYTES)
+
+    """
+    Split a line into (literals, slots) where literals has one more entry than slots
+    and the event is literals[0] + value(slots[0]) + literals[1] + ...
+    Only the first "time" field of a line is rebased.
+    """
+    def compileLine(self, line):
+        literals = []
+        slots = []
+        start = 0
+        found_time = False
+        for match in self.SLOT_PATTERN.finditer(line):
+            kind = match.lastindex - 1
+            if kind == self.TIME_SLOT:
+                if found_time:
+                    continue
+                found_time = True
+                literals.append(line[start:match.start(kind + 1)])
+                slots.append((kind, int(match.group(kind + 1))))
+            else:
+                literals.append(line[start:match.start()])
+                slots.append((kind, match.group(kind + 1)))
+            start = match.end()
+        literals.append(line[start:])
+        return (tuple(literals), tuple(slots))
+
+    def __len__(self):
+        return len(self.events)
+#End class
+
+"""
+The hostIdentity class carries a simulated machine's host names, SIDs, user names and
+SID domain from one template to the next in memory.
+"""
+class hostIdentity:
+    __slots__ = ('hosts', 'sids', 'usernames', 'sid_domain', 'rids')
+
+    def __init__(self, hosts, sids, usernames, sid_domain, rids):
+        self.hosts = hosts
+        self.sids = sids
+        self.usernames = usernames
+        self.sid_domain = sid_domain
+        self.rids = rids
+#End class
+
 class templateRandomizer:
     #Global Constants
     MACHINE_NAME_VARIABLE = '$HOST'
@@ -140,10 +320,20 @@ class templateRandomizer:
 
     sid_domain = ''
 
-    def __init__(self, template):
-        self.template_file = template
+    def __init__(self, template, rng=random):
+        #template is either an open template file or a compiledTemplate
+        #rng is the random.Random stream to draw generated values from
+        if isinstance(template, compiledTemplate):
+            self.template_file = None
+            self.template = template
+        else:
+            self.template_file = template
+            self.template = None
+        self.cursor = 0
+        self.time_base = None
+        self.event_time = 0 #template time of the last event returned by next_event
         self.is_recreating = False
-        self.generator = generateRandomData()
+        self.generator = generateRandomData(rng)
         self.variable_replace = replaceVariables()
         self.last_time = 0
         self.time_offset = 0
@@ -153,8 +343,16 @@ class templateRandomizer:
         self.host_dictionary = {}
         self.username_dictionary = {}
         self.lusername_dictionary = {}
+        self.pids = self.generator.pidAllocator()
+        self.rids = self.generator.ridAllocator()
 
-        random.seed()
+    """
+    Compile the template file on first use; raises ValueError if the template is malformed
+    """
+    def load_template(self):
+        if self.template is None:
+            self.template = compiledTemplate(self.template_file)
+        return self.template
 
     def recreate_test(self, key_file):
         self.is_recreating = True
@@ -186,11 +384,13 @@ class templateRandomizer:
                 pid_num = variable_finder.returnVariable(line, self.PID_VARIABLE, ":")
                 pid_value = variable_finder.returnVariableWithNoEnd(line, ": ")
                 self.PID_dictionary[pid_num] = pid_value
+                self.reserve(self.pids, pid_value)
 
             if line.find(self.SID_VARIABLE) != -1:
                 sid_num = variable_finder.returnVariable(line, self.SID_VARIABLE, ":")
                 sid_value = variable_finder.returnVariableWithNoEnd(line, ": ")
                 self.SID_dictionary[sid_num] = sid_value
+                self.reserve(self.rids, sid_value[sid_value.rfind('-') + 1:])
         #End for loop
         key_file.close()
 
@@ -204,10 +404,8 @@ class templateRandomizer:
     def generate_test_reuse_host(self, key_file):
         #Generate data
         try:
-            #Read first line of file and store time as total offset:
-            first_line = self.template_file.readline()
-            first_line = first_line.rstrip() #remove \n from end
-            self.time_offset = int(first_line)
+            #First line of the template holds the time used as total offset
+            self.time_offset = self.load_template().time_offset
 
             #Find current time and set as last time
             self.last_time = int(time.time())
@@ -226,6 +424,7 @@ class templateRandomizer:
                 sid_num = variable_finder.returnVariable(line, self.SID_VARIABLE, ":")
                 sid_value = variable_finder.returnVariableWithNoEnd(line, ": ")
                 self.SID_dictionary[sid_num] = sid_value
+                self.reserve(self.rids, sid_value[sid_value.rfind('-') + 1:])
                 self.sid_domain = sid_value[:sid_value.rfind('-')]
             if line.find(self.USER_NAME_VARIABLE) != -1:
                 username_num = variable_finder.returnVariable(line, self.USER_NAME_VARIABLE, ": ")
@@ -233,17 +432,15 @@ class templateRandomizer:
                 self.username_dictionary[username_num] = username
         return True
 
-    def generate_test(self):
+    def generate_test(self, last_time=None):
         #Generate data
 
         try:
-            #Read first line of file and store time as total offset:
-            first_line = self.template_file.readline()
-            first_line = first_line.rstrip() #remove \n from end
-            self.time_offset = int(first_line)
+            #First line of the template holds the time used as total offset
+            self.time_offset = self.load_template().time_offset
 
-            #Find current time and set as last time
-            self.last_time = int(time.time())
+            #Use the given time, or the current time, as last time
+            self.last_time = int(time.time()) if last_time is None else last_time
         except:
             return False
 
@@ -252,6 +449,42 @@ class templateRandomizer:
         self.sid_domain = self.generator.randomSIDdomain()
         return True
 
+    """
+    Generate a new test reusing the identity of a previous test, as returned by identity()
+    Return true if successful; false otherwise
+    """
+    def generate_test_reuse_identity(self, identity, last_time=None):
+        try:
+            #First line of the template holds the time used as total offset
+            self.time_offset = self.load_template().time_offset
+
+            #Use the given time, or the current time, as last time
+            self.last_time = int(time.time()) if last_time is None else last_time
+        except:
+            return False
+
+        #The previous test is finished with these, so share rather than copy them
+        self.host_dictionary = identity.hosts
+        self.SID_dictionary = identity.sids
+        self.username_dictionary = identity.usernames
+        self.sid_domain = identity.sid_domain
+        self.rids = identity.rids
+        return True
+
+    """
+    Returns the host, SID and user values of this test for reuse by the next one
+    """
+    def identity(self):
+        return hostIdentity(self.host_dictionary, self.SID_dictionary, self.username_dictionary,
+            self.sid_domain, self.rids)
+
+    #Mark a PID or RID read from a key file as in use, ignoring values that are not numbers
+    def reserve(self, allocator, value):
+        try:
+            allocator.reserve(value)
+        except ValueError:
+            pass
+
     def write_test_values(self, key_file):
         #Write key information
         key_writer = writeKey()
@@ -263,84 +496,70 @@ class templateRandomizer:
         key_file.write(key_writer.dictToString(self.SID_dictionary, self.SID_VARIABLE))
         key_file.write(key_writer.dictToString(self.PID_dictionary, self.PID_VARIABLE))
 
-    def next_event(self):
-        line = self.template_file.readline()
-        if line == '':
+    """
+    Returns the next filled event line, or None after the last one.
+    With bare set the event comes without the list brackets and newline.
+    """
+    def next_event(self, bare=False):
+        template = self.load_template()
+        if self.cursor >= len(template.events):
             return None
-
-        #Replace variables in template with data
-        #Search for and replace key word '$HOST' with new machine name
-        if line.find(self.MACHINE_NAME_VARIABLE) != -1:
-            num_of_occurences = range(1, line.count(self.MACHINE_NAME_VARIABLE)+1)
-            for index in num_of_occurences:
-                host_name_num = self.generator.findNum(line, self.MACHINE_NAME_VARIABLE)
-                if host_name_num in self.host_dictionary:
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.MACHINE_NAME_VARIABLE+str(host_name_num), str(self.host_dictionary[host_name_num]))
-                else:
-                    random_variable = self.generator.randomString()
-                    self.host_dictionary[host_name_num] = random_variable
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.MACHINE_NAME_VARIABLE+str(host_name_num), str(self.host_dictionary[host_name_num]))
-        #End search for '$HOST'
-
-        if line.find(self.SID_VARIABLE) != -1:
-            num_of_occurences = range(1, line.count(self.SID_VARIABLE) + 1)
-            for index in num_of_occurences:
-                sid_num = self.generator.findSIDNum(line)
-                if sid_num in self.SID_dictionary:
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.SID_VARIABLE+str(sid_num), str(self.SID_dictionary[sid_num]))
-                else:
-                    self.SID_dictionary[sid_num] = str(self.sid_domain) + "-" + str(self.generator.randomRID(self.SID_dictionary))
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.SID_VARIABLE+str(sid_num), str(self.SID_dictionary[sid_num]))
-        #end search for sid
-
-        if line.find(self.USER_NAME_VARIABLE) != -1:
-            num_of_occurences = range(1,line.count(self.USER_NAME_VARIABLE)+1)
-            for index in num_of_occurences:
-                username_num = self.generator.findNum(line, self.USER_NAME_VARIABLE)
-                if username_num in self.username_dictionary:
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.USER_NAME_VARIABLE+str(username_num), str(self.username_dictionary[username_num]))
-                else:
-                    self.username_dictionary[username_num] = str(self.generator.randomString())
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.USER_NAME_VARIABLE+str(username_num), str(self.username_dictionary[username_num]))
-        #end search for username
-
-        #search for lowercase usernames
-        if line.find(self.LUSERNAME_VARIABLE) != -1:
-            num_of_occurences = range(1, line.count(self.LUSERNAME_VARIABLE)+1)
-            for index in num_of_occurences:
-                lusername_num = self.generator.findNum(line, self.LUSERNAME_VARIABLE)
-                if lusername_num in self.lusername_dictionary:
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.LUSERNAME_VARIABLE+str(lusername_num), str(self.lusername_dictionary[lusername_num]))
-                else:
-                    self.lusername_dictionary[lusername_num] = (self.username_dictionary[lusername_num]).lower()
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.LUSERNAME_VARIABLE+str(lusername_num), str(self.lusername_dictionary[lusername_num]))
-        #end search for lowercase username
-
-        if line.find('"time":') != -1:
-            current_time = self.generator.findTime(line)
-            new_time = int(self.last_time) - (int(self.time_offset) - int(current_time))
-            line = self.variable_replace.removeAndReplaceVariable(line, str(current_time), str(new_time))
-        #end search for time
-
-        #Search for and replace '$PIDint' with new pid number
-        if line.find(self.PID_VARIABLE) != -1:
-            num_of_occurences = range(1, line.count(self.PID_VARIABLE) + 1)
-            for index in num_of_occurences:
-                pid_num = self.generator.findNum(line, self.PID_VARIABLE)
-                if self.is_recreating:
-                    try:
-                        pid_value = self.PID_dictionary[pid_num]
-                    except KeyError:
+        literals, slots = template.events[self.cursor]
+        self.cursor += 1
+        if not slots and not bare:
+            return literals[0]
+
+        #Fill each variable slot with known or newly generated data
+        parts = [literals[0]]
+        index = 1
+        for kind, key in slots:
+            if kind == compiledTemplate.HOST_SLOT:
+                value = self.host_dictionary.get(key)
+                if value is None:
+                    value = self.host_dictionary[key] = self.generator.randomString()
+            elif kind == compiledTemplate.PID_SLOT:
+                value = self.PID_dictionary.get(key)
+                if value is None:
+                    if self.is_recreating:
                         print("Wrong template was used. Please check input")
-                    line = self.variable_replace.removeAndReplaceVariable(line, self.PID_VARIABLE + str(pid_num), pid_value)
-                else:
-                    if pid_num in self.PID_dictionary:
-                        line = self.variable_replace.removeAndReplaceVariable(line, self.PID_VARIABLE+str(pid_num), str(self.PID_dictionary[pid_num]))
+                        value = ''
                     else:
-                        self.PID_dictionary[pid_num] = self.generator.randomPID(self.PID_dictionary)
-                        line = self.variable_replace.removeAndReplaceVariable(line, self.PID_VARIABLE+str(pid_num), str(self.PID_dictionary[pid_num]))
-        #End searching for PID
-        return line
+                        value = self.PID_dictionary[key] = self.pids.allocate()
+                value = str(value)
+            elif kind == compiledTemplate.TIME_SLOT:
+                self.event_time = key
+                if self.time_base is None:
+                    #Rebase in template units; event times are in seconds
+                    self.time_base = int(self.last_time) * compiledTemplate.TIME_UNITS - int(self.time_offset)
+                value = str((self.time_base + key) // compiledTemplate.TIME_UNITS)
+            elif kind == compiledTemplate.SID_SLOT:
+                value = self.SID_dictionary.get(key)
+                if value is None:
+                    value = self.SID_dictionary[key] = str(self.sid_domain) + "-" + str(self.rids.allocate())
+            elif kind == compiledTemplate.USERNAME_SLOT:
+                value = self.username_value(key)
+            else:
+                value = self.lusername_dictionary.get(key)
+                if value is None:
+                    value = self.lusername_dictionary[key] = self.username_value(key).lower()
+            parts.append(value)
+            parts.append(literals[index])
+            index += 1
+        if bare:
+            #Only the first and last literals hold the brackets and newline
+            if parts[0].startswith('['):
+                parts[0] = parts[0][1:]
+            last = parts[-1].rstrip('\r\n')
+            if last.endswith(']'):
+                last = last[:-1]
+            parts[-1] = last
+        return ''.join(parts)
+
+    def username_value(self, key):
+        value = self.username_dictionary.get(key)
+        if value is None:
+            value = self.username_dictionary[key] = str(self.generator.randomString())
+        return value
 
 def is_existing_file(parser, arg):
     if os.path.exists(arg):
@@ -18,82 +18,158 @@ Coded by rui@parc.com
 import json
 from pprint import pprint
 import sys
+import os
 import optparse
+import re
 import datetime
+import multiprocessing
+import shutil
+import tempfile
+
+# CompressedOutput is shared with the playback engine in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from CompressedOutput import compression_for, chunk_compressor, open_output
 
 class FD2PN(object):
     """FiveDirections Simulator Data to TC's ADAPT PROV-N"""
 
-    setAgents = {}
-    setEntities = {}
-    tmpPID = {}
-    chainPID = {}
+    EPOCH = datetime.datetime(1970, 1, 1)
+    CACHE_SIZE = 100000 # formatted values kept by iso8601 and quote
+
+    def __init__(self, evict=False):
+        """With evict set, a process's file activities and agent are dropped when it exits"""
+        # State of one conversion; nothing is shared between instances
+        self.setAgents = {} # host_pid -> (machineID, name, accountName or None, index)
+        self.setEntities = set() # dir\\file of each entity written
+        self.tmpPID = {} # pid -> {file: index of the last activity that opened it}
+        self.chainPID = {} # pid -> ppid
+        # (pid, file) -> (ancestor that opened file, generation it was found in)
+        self.ancestors = {}
+        self.fileGenerations = {} # file -> count of processes that have opened it
+        self.chainGeneration = 0 # bumped when a process gets a new parent or is evicted
+        self.names = {} # a single copy of each host, process and account name
+        self.evict = evict
+        self.times = {}
+        self.quoted = {}
 
     def iso8601(self, t):
-        delta = datetime.timedelta(seconds=t)
-        epoch = datetime.datetime.strptime("1970-01-01", "%Y-%m-%d")
-        time_str = str((epoch + delta).isoformat()) + 'Z'
+        # Events of a batch share a handful of timestamps, so each is formatted once
+        time_str = self.times.get(t)
+        if time_str is None:
+            if len(self.times) >= self.CACHE_SIZE:
+                self.times.clear()
+            delta = datetime.timedelta(seconds=t)
+            time_str = self.times[t] = str((self.EPOCH + delta).isoformat()) + 'Z'
         return time_str
 
+    def quote(self, value):
+        """json.dumps for the strings that repeat from event to event"""
+        quoted = self.quoted.get(value)
+        if quoted is None:
+            if len(self.quoted) >= self.CACHE_SIZE:
+                self.quoted.clear()
+            quoted = self.quoted[value] = json.dumps(value)
+        return quoted
+
+    def name(self, value):
+        return self.names.setdefault(value, value)
+
     def pretty_print_agent(self):
         #def not used at the moment
         ret = []
         for key in self.setAgents:
-            value = self.setAgents[key]
-            ret.append('agent(data:ag{}, [prov:type=\'tc:unitOfExecution\',' . format(value['index']))
-            ret.append('\ttc:machineID = {},' . format(json.dumps(value['adapt:machineID'])))
-            ret.append('\ttc:souce = {}' . format(json.dumps(value['foaf:name'])))
-            if "foaf:accountName" in value:
-                ret.append(',\n\tfoaf:accountName = {}])\n' . format(json.dumps(value['foaf:accountName'])))
+            machineID, name, accountName, index = self.setAgents[key]
+            ret.append('agent(data:ag{}, [prov:type=\'tc:unitOfExecution\',' . format(index))
+            ret.append('\ttc:machineID = {},' . format(json.dumps(machineID)))
+            ret.append('\ttc:souce = {}' . format(json.dumps(name)))
+            if accountName is not None:
+                ret.append(',\n\tfoaf:accountName = {}])\n' . format(json.dumps(accountName)))
             ret.append('])\n')
         return ret
 
-    def pretty_print_entities(self):
-        ret = []
-        for key in self.setEntities:
-            value = self.setEntities[key]
-            s = ('entity(data:ent{}, [\n'
-                #'\tprov:type=tc:artifact,\n'
-                '\ttc:entityType={},\n'
-                '\ttc:path={}])\n')
-            ret.append(s.format(value['index'], json.dumps(value['type']),
-                                json.dumps(value['dir'] + value['file'])))
-        return ret
+    def encodeEntity(self, entity, key, value, out):
+        s = ('\nentity(data:ent{}, [\n'
+            #'\tprov:type=tc:artifact,\n'
+            '\ttc:entityType={},\n'
+            '\ttc:path={}])\n')
+        out.write(s.format(value['index'], self.quote(key),
+                           json.dumps(value['dir'] + value['file'])))
 
     def getAgents(self,value):
         agent = value['host'] + '_' + str(value['pid'])
         if(agent not in self.setAgents):
-            agProperties = {}
-            agProperties['adapt:machineID'] = value['host']
-            agProperties['foaf:name'] = value['process']
-            if 'user' in value:
-                agProperties['foaf:accountName'] = value['user']
-            agProperties['index'] = value['index']
-            self.setAgents[agent] = agProperties
-
-    def getEntities(self, key, value):
+            user = value.get('user')
+            self.setAgents[agent] = (self.name(value['host']), self.name(value['process']),
+                                     None if user is None else self.name(user), value['index'])
+
+    def getEntities(self, key, value, out):
+        """Records the entity of a file event, writing it to out the first time it is seen"""
         if('file' not in value):
             value['file'] = "\\"
 
         entity = value['dir'] + "\\" + value['file']
         if(entity not in self.setEntities):
-            eProperties = {}
-            eProperties['dir'] = value['dir']
-            eProperties['file'] = value['file']
-            eProperties['index'] = value['index']
-            eProperties['type'] = key
-            self.setEntities[entity] = eProperties
+            self.setEntities.add(entity)
+            self.encodeEntity(entity, key, value, out)
+
+    def evictProcess(self, value):
+        """Forgets the file activities and agent of a process that exited"""
+        self.tmpPID.pop(value['pid'], None)
+        self.setAgents.pop(value['host'] + '_' + str(value['pid']), None)
+        self.chainGeneration += 1
+
+    def setParent(self, pid, ppid):
+        previous = self.chainPID.get(pid)
+        if previous is not None and previous != ppid:
+            # A reused pid moves its descendants to another ancestry
+            self.chainGeneration += 1
+        self.chainPID[pid] = ppid
+
+    def addActivity(self, pid, file, index):
+        files = self.tmpPID.get(pid)
+        if files is None:
+            files = self.tmpPID[pid] = {}
+        if file not in files:
+            # The nearest process to have opened file may now be a different one
+            self.fileGenerations[file] = self.fileGenerations.get(file, 0) + 1
+        files[file] = index
 
     def pid2activity(self, pid, file):
-        kk = str(pid) + "_" + file
-        if(kk in self.tmpPID):
-            return self.tmpPID[kk]
-        else:
-            return self.pid2activity(self.chainPID[pid], file)
-
-    def encodeProcess(self,value):
-        ret = []
-        s = ('activity(data:act{}, -, -, [\n'
+        """Returns the activity of the nearest process, pid itself or an ancestor, that opened
+        file, or "-" if the chain of parents breaks or loops before one is found.
+        The walk is iterative and each process passed on the way remembers the answer until
+        file is opened by another process or a parent changes."""
+        generation = (self.fileGenerations.get(file, 0), self.chainGeneration)
+        path = []
+        seen = set()
+        ancestor = None
+        while pid not in seen:
+            memo = self.ancestors.get((pid, file))
+            if memo is not None and memo[1] == generation:
+                ancestor = memo[0]
+                break
+            files = self.tmpPID.get(pid)
+            if(files is not None and file in files):
+                ancestor = pid
+                break
+            path.append(pid)
+            seen.add(pid)
+            if pid not in self.chainPID:
+                break
+            pid = self.chainPID[pid]
+        if ancestor is None:
+            return "-"
+
+        if len(self.ancestors) >= self.CACHE_SIZE:
+            self.ancestors.clear()
+        for pid in path:
+            self.ancestors[(pid, file)] = (ancestor, generation)
+        return "data:act" + str(self.tmpPID[ancestor][file])
+
+    # Each fragment starts with the newline that separates it from the one before
+
+    def encodeProcess(self, value, out):
+        s = ('\nactivity(data:act{}, -, -, [\n'
              #'\tprov:type=\'tc:unitOfExecution\',\n' #TODO: remove or keep?
              '\ttc:machineID={},\n'
              '\tfoaf:accountName={},\n'
@@ -104,54 +180,52 @@ class FD2PN(object):
              '\ttc:privs={},\n'
              '\ttc:commandLine={},\n'
              '\ttc:programName={}])\n')
-        ret.append(s.format(value['index'],
-                            json.dumps(value['host']),
-                            json.dumps(value['user']),
-                            json.dumps(value['dir']),
-                            self.iso8601(value['time']),
-                            json.dumps(str(value['pid'])),
-                            json.dumps(str(value['ppid'])),
-                            json.dumps(value['elevation']),
-                            json.dumps(value['cmd']),
-                            json.dumps(value['cmd'])))
-
-        activity = self.pid2activity(value['ppid'], value['file'])
-        s = 'wasStartedBy(data:wsb{}; data:act{}, {}, -, [\n\ttc:time=\"{}\"])\n'
-        ret.append(s.format(value['index'], value['index'], activity, self.iso8601(value['time'])))
-
-        return ret
-
-    def encodeFile(self, value):
-        ret = []
-        s = ('activity(data:act{}, -, -, [\n'
+        time_str = self.iso8601(value['time'])
+        cmd = self.quote(value['cmd'])
+        out.write(s.format(value['index'],
+                           self.quote(value['host']),
+                           self.quote(value['user']),
+                           self.quote(value['dir']),
+                           time_str,
+                           self.quote(str(value['pid'])),
+                           self.quote(str(value['ppid'])),
+                           self.quote(value['elevation']),
+                           cmd,
+                           cmd))
+
+        out.write('\nwasStartedBy(data:wsb{}; data:act{}, ' . format(value['index'], value['index']))
+        self.writeParentActivity(value['ppid'], value['file'], out)
+        out.write(', -, [\n\ttc:time=\"{}\"])\n' . format(time_str))
+
+    def writeParentActivity(self, ppid, file, out):
+        out.write(self.pid2activity(ppid, file))
+
+    def encodeFile(self, value, out):
+        s = ('\nactivity(data:act{}, -, -, [\n'
              #'\tprov:type=\'tc:unitOfExecution\',\n' #TODO: remove or keep?
              '\ttc:machineID={},\n'
              '\ttc:time=\"{}\",\n'
              '\ttc:pid={},\n'
              '\ttc:commandLine={},\n'
-             '\ttc:programName={}])\n')
-        ret.append(s.format(value['index'], json.dumps(value['host']),
-                                            self.iso8601(value['time']),
-                                            json.dumps(str(value['pid'])),
-                                            json.dumps(value['process']),
-                                            json.dumps(value['process'])))
-
-        #ret.append('wasAssociatedWith(data:as{}; data:act{}, data:ag{}, -, -)\n' . format(value['index'],
-        #                                                        value['index'], value['index']))
-
-        ret.append('used(data:us{}; data:act{}, data:ent{}, {},'
-                   '[tc:operation=\"open\", tc:privs={}])\n' . format(value['index'],
-                                                            value['index'], value['index'],
-                                                            self.iso8601(value['time']), json.dumps(value['action'])))
-
-        kk = str(value['pid']) + "_" + value['file']
-        self.tmpPID[kk] = "data:act" + str(value['index'])
-        return ret
-
-    def encodeNetwork(self, value):
-        ret = []
-
-        s = ('entity(data:socket{}, [\n'
+             '\ttc:programName={}])\n'
+             #'\nwasAssociatedWith(data:as{0}; data:act{0}, data:ag{0}, -, -)\n'
+             '\nused(data:us{}; data:act{}, data:ent{}, {},'
+             '[tc:operation=\"open\", tc:privs={}])\n')
+        index = value['index']
+        time_str = self.iso8601(value['time'])
+        process = self.quote(value['process'])
+        out.write(s.format(index, self.quote(value['host']),
+                                  time_str,
+                                  self.quote(str(value['pid'])),
+                                  process,
+                                  process,
+                                  index, index, index,
+                                  time_str, self.quote(value['action'])))
+
+        self.addActivity(value['pid'], value['file'], index)
+
+    def encodeNetwork(self, value, out):
+        s = ('\nentity(data:socket{}, [\n'
              #'\tprov:type=tc:metadata,\n' #TODO: remove or keep?
              '\ttc:entityType=\"network\",\n'
              '\ttc:sourceAddress={},\n'
@@ -159,67 +233,58 @@ class FD2PN(object):
              '\ttc:destinationAddress={},\n'
              '\ttc:destinationPort={},\n'
              '\ttc:machineID={},\n'
-             '\ttc:protocol={}])\n')
-        ret.append(s.format(value['index'],
-                            json.dumps(value['saddr']),
-                            json.dumps(str(value['sport'])),
-                            json.dumps(value['daddr']),
-                            json.dumps(str(value['dport'])),
-                            json.dumps(value['host']),
-                            json.dumps(value['protocol'])))
-
-        s = 'wasGeneratedBy(data:wgb{}; data:socket{}, data:act{}, -, [tc:operation={}, tc:time=\"{}\"])\n'
-        ret.append(s.format(value['index'], value['index'], value['index'],
-                            json.dumps(value['action']), self.iso8601(value['time'])))
-
-        #s = 'wasAssociatedWith(data:as{}; data:act{}, data:ag{}, -, [])\n'
-        #ret.append(s.format(value['index'], value['index'], value['index']))
-
-        return ret
-
-    def encodeRegistry(self, value):
-        ret = []
-
-        s = ('entity(data:reg{}, [\n'
+             '\ttc:protocol={}])\n'
+             '\nwasGeneratedBy(data:wgb{}; data:socket{}, data:act{}, -, [tc:operation={}, tc:time=\"{}\"])\n')
+             #'\nwasAssociatedWith(data:as{0}; data:act{0}, data:ag{0}, -, [])\n'
+        index = value['index']
+        out.write(s.format(index,
+                           self.quote(value['saddr']),
+                           self.quote(str(value['sport'])),
+                           self.quote(value['daddr']),
+                           self.quote(str(value['dport'])),
+                           self.quote(value['host']),
+                           self.quote(value['protocol']),
+                           index, index, index,
+                           self.quote(value['action']), self.iso8601(value['time'])))
+
+    def encodeRegistry(self, value, out):
+        s = ('\nentity(data:reg{}, [\n'
             #'\tprov:type=adapt:artifact,\n' #TODO: remove or keep?
             '\ttc:entityType=\"registryEntry\",\n'
-            '\ttc:registryKey={}])\n')
-        ret.append(s.format(value['index'], json.dumps(value['key'])))
-
-        s = ('activity(data:act{}, -, -, [\n'
+            '\ttc:registryKey={}])\n'
+            '\nactivity(data:act{}, -, -, [\n'
              #'\tprov:type=\'adapt:unitOfExecution\',\n' #TODO: remove or keep?
              '\ttc:machineID={},\n'
              '\ttc:time=\"{}\",\n'
              '\ttc:pid={},\n'
              '\ttc:commandLine={},\n'
-             '\ttc:programName={}])\n')
-        ret.append(s.format(value['index'], json.dumps(value['host']),
-                                            self.iso8601(value['time']),
-                                            json.dumps(str(value['pid'])),
-                                            json.dumps(value['process']),
-                                            json.dumps(value['process'])))
-
-        s = 'wasGeneratedBy(data:wgb{}; data:reg{}, data:ent{}, -, [\n\ttc:operation={}])\n'
-        ret.append(s.format(value['index'], value['index'], value['index'],
-                            json.dumps(value['action'])))
-
-        return ret
-
-    def encodeExit(self, value):
-        ret = []
-
-        s = ('activity(data:act{}, -, -, [\n'
+             '\ttc:programName={}])\n'
+             '\nwasGeneratedBy(data:wgb{}; data:reg{}, data:ent{}, -, [\n\ttc:operation={}])\n')
+        index = value['index']
+        process = self.quote(value['process'])
+        out.write(s.format(index, json.dumps(value['key']),
+                           index, self.quote(value['host']),
+                                  self.iso8601(value['time']),
+                                  self.quote(str(value['pid'])),
+                                  process,
+                                  process,
+                           index, index, index,
+                           self.quote(value['action'])))
+
+    def encodeExit(self, value, out):
+        s = ('\nactivity(data:act{}, -, -, [\n'
              #'\tprov:type=\'adapt:unitOfExecution\',\n' #TODO: remove or keep?
              '\ttc:machineID={},\n'
              '\ttc:time=\"{}\",\n'
              '\ttc:pid={},\n'
              '\ttc:commandLine={},\n'
              '\ttc:programName={}])\n')
-        ret.append(s.format(value['index'], json.dumps(value['host']),
-                                            self.iso8601(value['time']),
-                                            json.dumps(str(value['pid'])),
-                                            json.dumps(value['process']),
-                                            json.dumps(value['process'])))
+        process = self.quote(value['process'])
+        out.write(s.format(value['index'], self.quote(value['host']),
+                                           self.iso8601(value['time']),
+                                           self.quote(str(value['pid'])),
+                                           process,
+                                           process))
 
         #s = ('wasAssociatedWith(data:as{}; data:act{}, data:ag{}, -, [\n'
         #     '\tadapt:genOp=\"ret_val\",\n'
@@ -228,79 +293,292 @@ class FD2PN(object):
         #                                    value['index'],
         #                                    json.dumps(value['code'])))
 
-        return ret
-
-    def json2Prov(self, json):
-        pp = []
-
-        for i in xrange(len(json)):
-            for key, value in json[i].items():
-                for key, value in json[i].items() :
-                    if(key=='process'):
-                        self.chainPID[value['pid']] = value['ppid']
-
-        #print self.chainPID
-
-        for i in xrange(len(json)):
-            for key, value in json[i].items() :
-                if(key=='file' or key=='network' or key=='registry' or key=='exit'):
-                    self.getAgents(value)
+    def json2Prov(self, json, out):
+        """Writes the PROV-N of one decoded batch to out in a single pass over its events.
+        A process is linked to its parent as its event arrives, and an entity is written
+        just before the first event that uses it."""
+        for event in json:
+            for key, value in event.iteritems():
                 if(key=='file'):
-                    self.getEntities(key, value)
-
-        #pp += self.pretty_print_agent()
-        pp += self.pretty_print_entities()
-
-        for i in xrange(len(json)):
-            for key, value in json[i].items():
-                if(key=='file'):
-                    pp += self.encodeFile(value)
+                    self.getAgents(value)
+                    self.getEntities(key, value, out)
+                    self.encodeFile(value, out)
                 elif(key=='process'):
-                    pp += self.encodeProcess(value)
+                    self.setParent(value['pid'], value['ppid'])
+                    self.encodeProcess(value, out)
                 elif(key=='registry'):
-                    pp += self.encodeRegistry(value)
+                    self.getAgents(value)
+                    self.encodeRegistry(value, out)
                 elif(key=='network'):
-                    pp += self.encodeNetwork(value)
+                    self.getAgents(value)
+                    self.encodeNetwork(value, out)
                 elif(key=='exit'):
-                    pp += self.encodeExit(value)
+                    self.getAgents(value)
+                    self.encodeExit(value, out)
+                    if self.evict:
+                        self.evictProcess(value)
                 else:
                     print >>sys.stderr, "Parsing error (ignoring entry): " + key
 
-        return pp
+    def decodeBodies(self, f, first=1, end=None):
+        """Yields the decoded JSON body of each request in a capture, reading lazily.
+        f is positioned at line number first; see readRequests for end."""
+        for line, body in readRequests(f, first, end):
+            if body is not None:
+                print >>sys.stderr, "Decoding line " + str(line)
+                yield json.loads(body)
 
-    def getProvn(self, content):
-        pp = ["document\n", "prefix data <http://fivedirections.com/#>",
+    def writeHeader(self, out):
+        out.write('\n'.join(["document\n", "prefix data <http://fivedirections.com/#>",
               "prefix tc <http://spade.csl.sri.com/rdf/audit-tc.rdfs#>",
-              "prefix foaf <http://xmlns.com/foaf/0.1/>", ""]
-
-        for i in xrange(1,len(content)):
-            if(i % 9 == 0):
-                print >>sys.stderr, "Decoding line " + str(i)
-                decoded = json.loads(content[i-1])
-                #print json.dumps(decoded, sort_keys=True, indent=4)
-                pp += self.json2Prov(decoded)
-
-        pp.append("end document")
-        return pp
-
-    def getJson(self, content):
-        pp = ""
-
-        for i in xrange(1,len(content)):
-            if(i % 9 == 0):
-                print >>sys.stderr, "Decoding line " + str(i)
-                decoded = json.loads(content[i-1])
-                pp += json.dumps(decoded, sort_keys=True, indent=4)
-
-        return pp
+              "prefix foaf <http://xmlns.com/foaf/0.1/>", ""]))
+
+    def getProvn(self, f, out):
+        """Writes the PROV-N document for a capture to out batch by batch"""
+        self.writeHeader(out)
+
+        for decoded in self.decodeBodies(f):
+            #print json.dumps(decoded, sort_keys=True, indent=4)
+            self.json2Prov(decoded, out)
+
+        out.write('\nend document')
+
+    def getProvnSharded(self, path, out, processes):
+        """Writes the PROV-N document for the capture file at path to out, encoding shards
+        of it in parallel worker processes.
+        Workers leave out the parent activity of each process and report the entities they
+        saw and the pid state they changed; the shards are then merged in order here,
+        resolving parents and dropping entities declared by an earlier shard."""
+        tmpDir = tempfile.mkdtemp(prefix='provn-', dir=os.path.dirname(os.path.abspath(path)))
+        ranges = shardRanges(path, processes * SHARDS_PER_PROCESS)
+        jobs = [(path, start, end, firstLine,
+                 os.path.join(tmpDir, 'shard{}.provn'.format(k)), self.evict)
+                for k, (start, end, firstLine) in enumerate(ranges)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            self.writeHeader(out)
+            # imap hands back the shards in order while later ones are still encoding
+            for job, (entities, log) in zip(jobs, pool.imap(encodeShard, jobs)):
+                self.mergeShard(job[4], entities, log, out)
+            out.write('\nend document')
+        finally:
+            pool.terminate()
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    def mergeShard(self, shardPath, entities, log, out):
+        for entity, fragment in entities:
+            if entity not in self.setEntities:
+                self.setEntities.add(entity)
+                out.write(fragment)
+
+        # Replay the shard's pid state in order, resolving each parent as it comes up
+        activities = []
+        for evicted, tmp, chain, offset, ppid, file in log:
+            for pid in evicted:
+                self.tmpPID.pop(pid, None)
+                self.chainGeneration += 1
+            for pid, files in tmp.iteritems():
+                for opened, index in files.iteritems():
+                    self.addActivity(pid, opened, index)
+            for pid, parent in chain.iteritems():
+                self.setParent(pid, parent)
+            if offset is not None:
+                activities.append((offset, self.pid2activity(ppid, file)))
+
+        with open(shardPath, 'rb') as shard:
+            position = 0
+            for offset, activity in activities:
+                copyBytes(shard, out, offset - position)
+                out.write(activity)
+                position = offset
+            copyBytes(shard, out, None)
+        os.remove(shardPath)
+
+    def getJson(self, f, out):
+        for decoded in self.decodeBodies(f):
+            out.write(json.dumps(decoded, sort_keys=True, indent=4))
+
+class FD2PNShard(FD2PN):
+    """Encodes one shard of a capture for FD2PN.getProvnSharded.
+    Entities go to a list instead of the output; the parent activity of each process is
+    left out, and the evictions and tmpPID and chainPID updates made before it are logged
+    with its offset in the shard's output so that the parent can be resolved across shards."""
+
+    def __init__(self, evict=False):
+        FD2PN.__init__(self, evict)
+        # tmpPID, chainPID and evicted hold the changes since the last logged process
+        self.evicted = []
+        self.entities = [] # (entity, fragment) of each entity new to this shard
+        self.log = [] # (evicted pids, tmpPID updates, chainPID updates, offset, ppid, file)
+
+    def encodeEntity(self, entity, key, value, out):
+        fragment = []
+        FD2PN.encodeEntity(self, entity, key, value, ShardWriter(fragment.append))
+        self.entities.append((entity, ''.join(fragment)))
+
+    def evictProcess(self, value):
+        FD2PN.evictProcess(self, value)
+        self.evicted.append(value['pid'])
+
+    def writeParentActivity(self, ppid, file, out):
+        self.log.append((self.evicted, self.tmpPID, self.chainPID, out.size, ppid, file))
+        self.evicted = []
+        self.tmpPID = {}
+        self.chainPID = {}
+
+    def finish(self):
+        self.log.append((self.evicted, self.tmpPID, self.chainPID, None, None, None))
+        return self.entities, self.log
+
+class ShardWriter(object):
+    """Counts the bytes passed on to write"""
+
+    def __init__(self, write):
+        self.size = 0
+        self.writeTo = write
+
+    def write(self, data):
+        self.writeTo(data)
+        self.size += len(data)
+
+SHARDS_PER_PROCESS = 4 # extra shards keep every process busy while the merge catches up
+BLOCK_SIZE = 1 << 20
+
+def shardRanges(path, count):
+    """Splits the capture at path into up to count (start, end, firstLine) byte ranges that
+    each begin with a request line; firstLine is the line number at start."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    firstLine = 1
+    lines = 0
+    offset = 0
+    with open(path, 'rb') as f:
+        for k in xrange(1, count):
+            target = size * k // count
+            # Count newlines a block at a time, then finish the line the target falls in
+            while offset < target:
+                block = f.read(min(BLOCK_SIZE, target - offset))
+                lines += block.count('\n')
+                offset += len(block)
+            rest = f.readline()
+            offset += len(rest)
+            lines += rest.endswith('\n')
+            # Bodies never start with a request line, so the next one starts a request
+            while True:
+                line = f.readline()
+                if not line or REQUEST_LINE.match(line):
+                    break
+                offset += len(line)
+                lines += line.endswith('\n')
+            f.seek(offset)
+            if offset <= start or offset >= size:
+                continue
+            ranges.append((start, offset, firstLine))
+            start = offset
+            firstLine = lines + 1
+    ranges.append((start, size, firstLine))
+    return ranges
+
+REQUEST_LINE = re.compile(r'[A-Z]+ \S+ HTTP/\d\.\d\r?\n')
+
+def readRequests(f, line=1, end=None):
+    """Yields (line, body) for each HTTP request in the capture f, read from its current
+    position, which is at line number line. The body, None for a request without one, is
+    framed by its Content-Length or chunked encoding and line is the one it starts on.
+    Requests starting at byte offset end or later, and one cut short by the end of the
+    capture, are left out."""
+    position = f.tell()
+    while end is None or position < end:
+        request = f.readline()
+        if not request:
+            return
+        position += len(request)
+        line += 1
+        if not REQUEST_LINE.match(request):
+            continue # not part of a request; look for the next one
+        headers = {}
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            position += len(header)
+            line += 1
+            if not header.strip():
+                break
+            name, _, value = header.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        start = line
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = f.readline()
+                if not size.endswith('\n'):
+                    return
+                length = int(size.split(';')[0], 16)
+                data = f.read(length) if length else ''
+                # CRLF after each chunk; after the last one, trailers up to a blank line
+                trailer = f.readline()
+                while length == 0 and trailer.strip():
+                    position += len(trailer)
+                    line += 1
+                    trailer = f.readline()
+                if len(data) < length or not trailer.endswith('\n'):
+                    return
+                position += len(size) + length + len(trailer)
+                line += 1 + data.count('\n') + 1
+                if length == 0:
+                    break
+                chunks.append(data)
+            body = ''.join(chunks)
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            body = f.read(length)
+            if len(body) < length:
+                return
+            position += length
+            line += body.count('\n')
+        else:
+            body = None
+        yield start, body
+
+def copyBytes(source, out, count):
+    """Copies count bytes, or everything left when count is None, from source to out"""
+    while count is None or count > 0:
+        block = source.read(BLOCK_SIZE if count is None else min(BLOCK_SIZE, count))
+        if not block:
+            break
+        out.write(block)
+        if count is not None:
+            count -= len(block)
+
+def encodeShard(job):
+    """Pool worker: encodes one byte range of a capture into its own file"""
+    path, start, end, firstLine, shardPath, evict = job
+    encoder = FD2PNShard(evict)
+    with open(path, 'rb') as f:
+        with open(shardPath, 'wb') as shardFile:
+            out = ShardWriter(shardFile.write)
+            f.seek(start)
+            for decoded in encoder.decodeBodies(f, firstLine, end):
+                encoder.json2Prov(decoded, out)
+    return encoder.finish()
 
 if __name__ == '__main__':
-    usage = "usage: %prog inputFile outputFile"
+    usage = ("usage: %prog inputFile outputFile\n\n"
+             "outputFile is compressed if it ends in .gz or .zst")
     optp = optparse.OptionParser(usage = usage, version = "%prog 1.0")
 
     optp.add_option("-j", "--json",
                   action="store_true", dest="jpp", default=False,
                   help="Pretty-print json to outputFile")
+    optp.add_option("-e", "--evict",
+                  action="store_true", dest="evict", default=False,
+                  help="Forget the file activity of each process once it exits")
+    optp.add_option("-p", "--processes",
+                  type="int", dest="processes", default=1,
+                  help="Convert shards of inputFile in this many processes in parallel")
 
 
     (opts, args) = optp.parse_args()
@@ -308,13 +586,22 @@ if __name__ == '__main__':
     if not (len(args) == 2):
         optp.error("Missing file argument")
 
-    with open(args[0]) as f:
-        content = f.readlines()
+    if compression_for(args[1]):
+        try:
+            chunk_compressor(compression_for(args[1]))
+        except ImportError as e:
+            optp.error(str(e))
 
-    outFile =  open(args[1], "w")
-    fs2pn = FD2PN()
+    outFile = open_output(args[1])
+    fs2pn = FD2PN(opts.evict)
 
-    if(opts.jpp):
-        outFile.write(fs2pn.getJson(content))
+    if(opts.processes > 1 and not opts.jpp):
+        fs2pn.getProvnSharded(args[0], outFile, opts.processes)
     else:
-        outFile.write('\n'.join(fs2pn.getProvn(content)))
+        # The capture is read a request at a time and the output written as it is produced
+        with open(args[0], 'rb') as f:
+            if(opts.jpp):
+                fs2pn.getJson(f, outFile)
+            else:
+                fs2pn.getProvn(f, outFile)
+    outFile.close()
@@ -15,9 +15,8 @@ do
 
   echo "Processing ${Red}$fn${Color_Off}..."
 
-  python ../converter.py $f $fn.provn
-
-  gzip $fn.provn
+  # Encoded in shards on every core and compressed on background threads
+  python ../converter.py -p $(getconf _NPROCESSORS_ONLN) $f $fn.provn.gz
 
 done
 
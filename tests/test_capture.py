@@ -0,0 +1,161 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import Counter
+import os
+import shutil
+from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+import sys
+import tempfile
+from threading import Lock, Thread
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'converter2provn'))
+from SyntheticPlaybackEngine import PlaybackEngine
+from converter import FD2PN, readRequests
+
+'''Round trip from the playback engine to the PROV-N converter: requests sent by the engine
+are captured byte for byte, as a raw capture of the target would record them, and the
+converter has to find every batch in the capture.'''
+
+TEMPLATE = os.path.join(ROOT, 'templates', 'phototemplate.txt')
+
+"""
+Counts the bytes read from a socket file and keeps them until taken, so that each request
+can be copied to the capture exactly as it arrived.
+"""
+class RecordingFile:
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+        self.data = []
+
+    def readline(self):
+        line = self.f.readline()
+        self.record(line)
+        return line
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.record(data)
+        return data
+
+    def record(self, data):
+        self.position += len(data)
+        self.data.append(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = ''.join(self.data)
+        self.data = []
+        return data
+
+"""
+A stand-in target that answers each request with an empty 200 and appends the raw
+requests to a capture, one whole request at a time.
+"""
+class CaptureServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        TCPServer.__init__(self, ('127.0.0.1', 0), CaptureHandler)
+        self.requests = []
+        self.lock = Lock()
+
+    def capture(self):
+        return ''.join(self.requests)
+
+class CaptureHandler(StreamRequestHandler):
+    def handle(self):
+        f = RecordingFile(self.rfile)
+        for line, body in readRequests(f):
+            with self.server.lock:
+                self.server.requests.append(f.take())
+            self.wfile.write('HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+            self.wfile.flush()
+
+class CaptureRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.server = CaptureServer()
+        t = Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.work_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+        self.server.shutdown()
+        self.server.server_close()
+
+    """
+    Play one template for two machines and return the number of events sent and the
+    path of the capture.
+    """
+    def play(self, chunked):
+        engine = PlaybackEngine(TEMPLATE, 2, 1, 'http://127.0.0.1:{0}/'.format(self.server.server_address[1]),
+            None, 0, False, batch_size=100, stats_interval=0, seed=1, chunked=chunked)
+        engine.start()
+        path = os.path.join(self.work_dir, 'capture.raw')
+        with open(path, 'wb') as f:
+            f.write(self.server.capture())
+        return engine.metrics.batched_events, path
+
+    def convert(self, path, processes=1):
+        converted = os.path.join(self.work_dir, 'capture.provn')
+        with open(converted, 'wb') as out:
+            if processes > 1:
+                FD2PN().getProvnSharded(path, out, processes)
+            else:
+                with open(path, 'rb') as f:
+                    FD2PN().getProvn(f, out)
+        with open(converted, 'rb') as f:
+            return f.read()
+
+    def decoded_events(self, path):
+        with open(path, 'rb') as f:
+            return sum(len(body) for body in FD2PN().decodeBodies(f))
+
+    def test_bodies_follow_the_earlier_request_layout(self):
+        sent, path = self.play(False)
+        self.assertTrue(sent > 100)
+        for request in self.server.requests:
+            # Request line, six headers and a blank line, then the body on the ninth line
+            lines = request.split('\n')
+            self.assertEqual(lines[7], '\r')
+            self.assertTrue(lines[8].startswith('[{'))
+        self.assertEqual(self.decoded_events(path), sent)
+
+    def test_chunked_capture_converts(self):
+        sent, path = self.play(True)
+        self.assertTrue(all('Transfer-Encoding: chunked' in request for request in self.server.requests))
+        self.assertEqual(self.decoded_events(path), sent)
+        self.assertTrue(self.convert(path).endswith('end document'))
+
+    def test_sharded_conversion_matches(self):
+        sent, path = self.play(False)
+        sequential = self.convert(path)
+        sharded = self.convert(path, 3)
+        self.assertEqual(Counter(sequential.split('\n\n')), Counter(sharded.split('\n\n')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import Counter
+import os
+import sys
+from threading import Event, Lock
+from time import sleep
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+from SyntheticPlaybackEngine import HostScheduler, ReplayScheduler, SimulatedHost, TemplateCache
+
+'''Hosts parked by the replay scheduler and resumed by it while executors share them.'''
+
+TEMPLATE = os.path.join(ROOT, 'templates', 'phototemplate.txt')
+HOSTS = 6
+
+"""
+A replay scheduler that parks every other event it is offered and resumes the host at once,
+before schedule() returns, so that another executor can take the host while the first one
+is still parking it.
+"""
+class ResumingReplay(ReplayScheduler):
+    def __init__(self):
+        ReplayScheduler.__init__(self, None)
+        self.offers = 0
+        self.released = []
+
+    def schedule(self, event, release, resume):
+        with self.lock:
+            self.offers += 1
+            park = self.offers % 2 == 0
+            if not park:
+                self.released.append(event)
+        if park:
+            resume()
+            sleep(0.001)
+            return False
+        return True
+
+def new_host(id, replay=None):
+    return SimulatedHost(id, [TEMPLATE], TemplateCache(), 1, False, replay, seed=1,
+        start_time=SimulatedHost.DEFAULT_START_TIME)
+
+class ParkingTest(unittest.TestCase):
+    def test_no_event_is_lost_or_duplicated(self):
+        expected = Counter()
+        for id in range(HOSTS):
+            host = new_host(id)
+            events = []
+            while host.run_slice(HostScheduler.QUANTUM, events, None)[0] != SimulatedHost.FINISHED:
+                pass
+            expected.update(events)
+
+        replay = ResumingReplay()
+        done = Event()
+        scheduler = HostScheduler([new_host(id, replay) for id in range(HOSTS)], 8, lambda: None,
+            lambda scheduler: done.set())
+        scheduler.start()
+        self.assertTrue(done.wait(60))
+        self.assertEqual(Counter(replay.released), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import httplib
+import os
+import socket
+import sys
+from threading import Thread
+from time import sleep, time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from SyntheticPlaybackEngine import HTTPSender
+from test_capture import CaptureServer
+
+'''Timeouts seen by the HTTP sender: a batch is resent unless the request went out.'''
+
+BATCH = ['{"type":"test","id":1}', '{"type":"test","id":2}']
+
+class TimingOutConnection(httplib.HTTPConnection):
+    def connect(self):
+        raise socket.timeout('timed out')
+
+"""
+A sender whose first connection times out while connecting, as when the target's listen
+backlog is full.
+"""
+class ConnectTimeoutSender(HTTPSender):
+    def __init__(self, url):
+        HTTPSender.__init__(self, url, in_flight=1, timeout=1, retry_wait=0)
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        if self.connects == 1:
+            return TimingOutConnection(self.host, self.port)
+        return HTTPSender.connect(self)
+
+"""
+Submit batch to sender and wait up to timeout seconds for it to be handled.
+"""
+def send(sender, batch, timeout=10):
+    sender.start()
+    sender.submit(batch)
+    deadline = time() + timeout
+    while sender.busy() and time() < deadline:
+        sleep(0.01)
+    sender.close()
+
+class SenderTimeoutTest(unittest.TestCase):
+    def test_connect_timeout_is_retried(self):
+        server = CaptureServer()
+        t = Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            sender = ConnectTimeoutSender('http://127.0.0.1:{0}/'.format(server.server_address[1]))
+            send(sender, BATCH)
+            self.assertEqual(sender.connects, 2)
+            self.assertEqual(sender.metrics.timeouts, 0)
+            self.assertEqual(sender.metrics.retries, 1)
+            self.assertEqual(sender.metrics.requests, 1)
+            self.assertEqual(len(server.requests), 1)
+            self.assertTrue(server.requests[0].endswith('[' + ','.join(BATCH) + ']\r\n'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_response_timeout_is_not_resent(self):
+        # Connections complete in the backlog, but nothing is ever read or answered
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            sender = HTTPSender('http://127.0.0.1:{0}/'.format(listener.getsockname()[1]),
+                in_flight=1, timeout=0.5, retry_wait=0)
+            send(sender, BATCH)
+            self.assertFalse(sender.busy())
+            self.assertEqual(sender.metrics.timeouts, 1)
+            self.assertEqual(sender.metrics.retries, 0)
+            self.assertEqual(sender.metrics.requests, 0)
+        finally:
+            listener.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Copyright 2015 Five Directions, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import re
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+from SyntheticPlaybackEngine import ReplayScheduler, SimulatedHost, TemplateCache
+
+'''Event times written by a simulated host, against the replay schedule and across the
+templates a host plays in turn.'''
+
+TEMPLATES = [os.path.join(ROOT, 'templates', name)
+    for name in ['phototemplate.txt', 'painttemplate.txt', 'videotemplate.txt']]
+TIME = re.compile(r'"time":(\d+)')
+
+"""
+A replay scheduler that records each event with its release time instead of releasing it.
+"""
+class RecordingReplay(ReplayScheduler):
+    def __init__(self, speed):
+        ReplayScheduler.__init__(self, None, speed)
+        self.scheduled = []
+
+    def schedule(self, event, release, resume):
+        self.scheduled.append((event, release))
+        return True
+
+"""
+Run host until it finishes and return the events it generated.
+"""
+def run_host(host):
+    events = []
+    while host.run_slice(10000, events, None)[0] != SimulatedHost.FINISHED:
+        pass
+    return events
+
+def event_time(event):
+    return int(TIME.search(event).group(1))
+
+class TimelineTest(unittest.TestCase):
+    def test_event_times_follow_the_release_schedule(self):
+        speed = 50
+        replay = RecordingReplay(speed)
+        run_host(SimulatedHost(0, TEMPLATES[:1], TemplateCache(), 1, False, replay, seed=1))
+        first_event, first_release = replay.scheduled[0]
+        last_event, last_release = replay.scheduled[-1]
+        self.assertTrue(event_time(last_event) > event_time(first_event))
+        for event, release in replay.scheduled:
+            # Event times are whole seconds
+            self.assertAlmostEqual(event_time(event) - event_time(first_event),
+                (release - first_release) * speed, delta=1)
+
+    def test_event_times_match_release_at_speed_1(self):
+        replay = RecordingReplay(1)
+        run_host(SimulatedHost(0, TEMPLATES[:1], TemplateCache(), 1, False, replay, seed=1))
+        first_event, first_release = replay.scheduled[0]
+        last_event, last_release = replay.scheduled[-1]
+        self.assertEqual(event_time(first_event), int(first_release))
+        self.assertAlmostEqual(event_time(last_event), last_release, delta=1)
+
+    def test_times_never_decrease_across_iterations(self):
+        start = SimulatedHost.DEFAULT_START_TIME
+        host = SimulatedHost(0, TEMPLATES, TemplateCache(), 6, False, seed=1, start_time=start)
+        times = [event_time(event) for event in run_host(host)]
+        self.assertEqual(host.current_iteration, 6)
+        self.assertEqual(times[0], start)
+        for previous, current in zip(times, times[1:]):
+            self.assertTrue(current >= previous)
+
+if __name__ == '__main__':
+    unittest.main()